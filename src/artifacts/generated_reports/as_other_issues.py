@@ -1,6 +1,5 @@
 import os
 import csv
-import json
 from datetime import datetime
 from integrations.google_api import sync_sheet_table, authenticate_service_account
 from util.secrets import secret
@@ -46,8 +45,7 @@ class OtherIssuesReport:
     ignored_categories = [ "housing", "youthform", "tournament", "membership", "payment" ]
     
     for attendee in self.badgefile.attendees():
-      for issue_json in attendee.open_issues().values():
-        issue = json.loads(issue_json)
+      for issue in attendee.parsed_open_issues().values():
         if issue['category'] not in ignored_categories:
           attendee_issues.append([attendee, issue])
 
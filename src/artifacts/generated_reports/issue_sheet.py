@@ -1,4 +1,3 @@
-import json
 import csv
 import os
 from datetime import datetime
@@ -59,8 +58,7 @@ class IssueSheet:
 
       preamble = attendee_preamble + primary_preamble + transaction_preamble
 
-      for issue_type, issue_data in attendee.open_issues().items():
-        parsed = json.loads(issue_data)
+      for issue_type, parsed in attendee.parsed_open_issues().items():
         issues.append(preamble + [issue_type, parsed['code'], parsed['msg']])
     
     # Sort issues by [(primary last name, primary first name), name_family, name_given, date_of_birth, issue_type]
@@ -33,11 +33,7 @@ class Checksheet:
       return False
 
   def issues_of_type(self, type):
-    import json
-    open_issues = self.attendee.open_issues()
-    parsed = [json.loads(issue) for issue in open_issues.values()]
-    in_category = [issue for issue in parsed if issue['category'] == type]
-    return in_category
+    return self.attendee.issues_in_category(type)
   
   def path(self):
     info = self.attendee.info()
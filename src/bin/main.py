@@ -81,7 +81,7 @@ def download():
   except Exception as exc:
     log.critical("Failed to download donations report", exception=exc)
 
-def update():
+def update(full_rescan=False):
   if Reglist.latest() == None:
     Reglist.download()
   if ActivityList.latest() == None:
@@ -103,6 +103,8 @@ def update():
 
   log.notice(f"Updating badgefile.")
   bf = Badgefile()
+  if full_rescan:
+    bf.request_full_rescan() # re-run every issue check, even those whose inputs haven't changed since the last run
   bf.update()
   bf.update_attendees() # TODO: this might be redundant at this point; can't remember if there was a reason we needed to re-run before doing approvals.
   bf.run_approvals()
@@ -119,7 +121,7 @@ log.notice(f"Git: {git_summary()}")
 try:
   if "download" in sys.argv:
     download()
-  update()
+  update(full_rescan="--full-rescan" in sys.argv)
 
   log.notice(f"Complete. Runtime: {time.time() - start_time:.03f}s")
 except Exception as exc:
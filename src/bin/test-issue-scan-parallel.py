@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import pathlib
+
+src_path = pathlib.Path(__file__).parent.parent
+sys.path.append(str(src_path))
+
+from model.badgefile import Badgefile
+from model.attendee import ReglistCacher
+from util.util import *
+from log.logger import log
+
+# Runs the issue checks for every attendee with more than one active registration (the case check 2g flags) both
+# serially and through the parallel worker path, and makes sure both give the same issues.
+
+badgefile = Badgefile()
+badgefile.is_online = False # don't pull the youth form sheet; 2f will just report everyone as missing one
+
+reglist = badgefile.attendees()[0].latest_reglist()
+rrbid = ReglistCacher.shared().reglist_rows_by_id(reglist, badgefile)
+duplicates = [attendee for attendee in badgefile.attendees()
+              if len([row for row in rrbid.get(attendee.id(), []) if row['status'].lower() == "open"]) >= 2]
+
+if len(duplicates) == 0:
+  print("No attendees with multiple active registrations to test")
+  os._exit(1)
+print(f"Testing {len(duplicates)} attendees with multiple active registrations")
+
+serial = {attendee: attendee.run_issue_checks() for attendee in duplicates}
+parallel = dict(badgefile.run_issue_checks_parallel(duplicates, 4, {}, {attendee: {} for attendee in duplicates}))
+
+failed = False
+for attendee in duplicates:
+  if '2g_registration_duplicate' not in parallel.get(attendee, {}):
+    log.error(f"Parallel scan didn't flag {attendee.full_name()} {attendee.id()} with 2g")
+    failed = True
+  if serial[attendee] != parallel.get(attendee):
+    log.error(f"Serial and parallel scans disagree for {attendee.full_name()} {attendee.id()}: {serial[attendee]} vs {parallel.get(attendee)}")
+    failed = True
+
+print("FAILED" if failed else "OK")
+os._exit(1 if failed else 0)
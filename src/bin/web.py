@@ -14,6 +14,7 @@ from server.socketserver import SocketServer
 from server.webservice import WebService
 from model.badgefile import Badgefile
 from model.event import Event
+from model.scan_ingest import ScanIngest
 from model.leago_sync import LeagoSync
 from log.logger import log
 from artifacts.generated_reports.as_overview import OverviewReport
@@ -72,6 +73,10 @@ def main():
                         port=args.port)
     
     SocketServer.shared().listen()
+    if ScanIngest.shared().enabled():
+      # recover the congress check-in state from the scans table now, rather than on the first scan
+      Event("congress").scan_counts()
+      ScanIngest.shared().start()
     updater = OverviewUpdater(badgefile)
 
     print(f"Starting WebService on {args.interface}:{args.port}")
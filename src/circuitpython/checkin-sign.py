@@ -216,7 +216,7 @@ class DataSource:
                 if not self.last_update and time.monotonic() > self.init_time + 2.0:
                     print("DataSource: No data seen within 2 seconds of boot; trying synchronous request via HTTP")
                     valid_update = self.web_client.get_data_immediate()
-            elif self.last_update_time - time.monotonic() > 5*60:
+            elif time.monotonic() - self.last_update_time > 5*60:
                 # we haven't seen data in a few minutes, so go ahead and do an HTTP GET
                 # the socket might be having problems...
                 print("DataSource: No data seen in a while; trying synchronous request via HTTP")
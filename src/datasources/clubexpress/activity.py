@@ -53,8 +53,7 @@ class Activity:
     db = Database.shared()
     
     # Get all existing activity_registrant_ids from the database
-    existing_ids_rows = db.query("SELECT DISTINCT activity_registrant_id FROM Activities")
-    existing_ids = [row['activity_registrant_id'] for row in existing_ids_rows]
+    existing_ids = [row[0] for row in db.iter_query("SELECT DISTINCT activity_registrant_id FROM Activities", row_factory="tuple")]
     
     # Find IDs that exist in the database but not in our current list
     ids_to_delete = set(existing_ids) - unique_ids
@@ -85,36 +84,30 @@ class Activity:
 
   def sync_to_db(self):
     log.trace(f"syncing activity to db")
-    self.ensure_activities_table()
     info = self.info()
     if 'json' in info:
       del(info['json'])
 
-    keys = [defn[0] for defn in self.column_definitions()]
-    set_clause = "badgefile_id=?, json=?, " + ", ".join([f"{key}=?" for key in keys])
+    column_defns = self.column_definitions()
+    self.ensure_activities_table(column_defns)
+
+    keys = tuple(defn[0] for defn in column_defns)
     base_args = [self.attendee.id(), json.dumps(info)] + [info[key] for key in keys]
     update_args = base_args + [info["activity_registrant_id"]]
 
-    update_sql = f"UPDATE Activities SET {set_clause} WHERE activity_registrant_id=?"
+    update_sql = self.db.cached_statement(("Activities", "update", keys),
+      lambda: f"UPDATE Activities SET badgefile_id=?, json=?, {', '.join([f'{key}=?' for key in keys])} WHERE activity_registrant_id=?")
     affected_rows = self.db.execute(update_sql, update_args)
 
     if affected_rows == 0:
-      insert_sql = f"INSERT INTO Activities (badgefile_id, json, {','.join(keys)}) VALUES (?, ?, {', '.join(['?' for _ in keys])})"
+      insert_sql = self.db.cached_statement(("Activities", "insert", keys),
+        lambda: f"INSERT INTO Activities (badgefile_id, json, {','.join(keys)}) VALUES (?, ?, {', '.join(['?' for _ in keys])})")
       self.db.execute(insert_sql, base_args)
     
-  def ensure_activities_table(self):
-    self.db.execute("CREATE TABLE IF NOT EXISTS Activities(badgefile_id INTEGER NOT NULL, json TEXT NOT NULL)")
-    defns_dict = { col[0]: col[1] for col in self.column_definitions() } 
-    existing_cols = self.db.columns_of_table("Activities")
-    expected_cols = defns_dict.keys()
-    missing_columns = list(set(expected_cols) - set(existing_cols))
-    missing_defns = [[col, defns_dict[col]] for col in missing_columns if col in defns_dict]
-    
-    for defn in missing_defns:
-      name, type = defn
-      query = f"ALTER TABLE Activities ADD COLUMN {name} {type} DEFAULT NULL;"
-      log.debug(f"Adding column {name} of type {type}")
-      self.db.execute(query)
+  def ensure_activities_table(self, column_defns=None):
+    # cached in Database's schema registry; only touches the database the first time, or when a new column appears
+    self.db.ensure_table("Activities", "CREATE TABLE IF NOT EXISTS Activities(badgefile_id INTEGER NOT NULL, json TEXT NOT NULL)")
+    self.db.ensure_columns("Activities", column_defns if column_defns is not None else self.column_definitions())
     
     # TODO: add indexes on [badgefile_id] and [activity_registrant_id]
 
@@ -129,7 +122,8 @@ class Activity:
     if "json" in implicit_keys:
       implicit_keys.remove("json") # ditto
     
-    return [ [key, "INTEGER" if isinstance(info[key], int) else "REAL" if isinstance(info[key], float) else "TEXT"] for key in implicit_keys ]
+    # sorted, so the same set of keys always produces the same column list (and the same cached SQL)
+    return [ [key, "INTEGER" if isinstance(info[key], int) else "REAL" if isinstance(info[key], float) else "TEXT"] for key in sorted(implicit_keys) ]
 
   def explicit_column_definitions(self):
     return [
@@ -41,7 +41,8 @@ class Reglist(CEReportBase):
 
   # return a list of all ReglistRows in this Reglist
   def rows(self):
-    return [ReglistRow(self, row) for row in csv.reader(StringIO(self.csv.decode("utf-8")))][1:]
+    lines = list(csv.reader(StringIO(self.csv.decode("utf-8"))))
+    return [ReglistRow(self, row, row_num) for row_num, row in enumerate(lines[1:], start=2)]
     
   def heading_map(self):
     return {
@@ -5,9 +5,10 @@ class ReglistRow:
 
   # TODO: in hindsight I think this is an unnecessary abstraction and can be removed.
 
-  def __init__(self, reglist, row):
+  def __init__(self, reglist, row, row_num=None):
     self.reglist = reglist
     self.row = row
+    self.row_num = row_num # excel-style row number (one-based, counting the header row), if known
     self._info = self.parse_info()
 
   def parse_info(self):
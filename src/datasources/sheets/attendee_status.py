@@ -37,9 +37,14 @@ class AttendeeStatusSource:
       result.append(row_dict)
     return result
 
-  def read_tournament_overrides(self):    
+  def read_tournament_data(self):
     file_id = self.locate_file()
-    data = read_sheet_data(self.service, file_id, "Tournaments")
+    return read_sheet_data(self.service, file_id, "Tournaments")
+
+  # apply the Tournaments sheet to attendees. pass data from read_tournament_data() to avoid re-reading the sheet.
+  def read_tournament_overrides(self, data=None):
+    if data is None:
+      data = self.read_tournament_data()
 
     if data is None or len(data) == 0:
       log.info("Unable to read tournament overrides; Tournaments sheet is missing or empty")
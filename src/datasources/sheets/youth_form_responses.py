@@ -4,22 +4,28 @@ from integrations.google_api import read_sheet_data, authenticate_service_accoun
 from log.logger import log
 
 class YouthFormResponses:
-  def __init__(self, badgefile, force_online=False):
+  # pass data from read_sheet_data() to use rows that were already pulled, rather than pulling the sheet again
+  def __init__(self, badgefile, force_online=False, data=None):
     self.badgefile = badgefile
-    if force_online or self.badgefile.is_online:
-      self.read_sheet()
+    if data is not None or force_online or self.badgefile.is_online:
+      self.read_sheet(data)
     else:
       self.responses = {}
 
+  @classmethod
+  def read_sheet_data(cls):
+    service = authenticate_service_account()
+    file_id = secret("youth_form_response_file_id")
+    return read_sheet_data(service, file_id)
+
   def youth_form(self, attendee):
     return self.responses.get(attendee.id(), None)
 
-  def read_sheet(self):
+  def read_sheet(self, data=None):
     log.info(f"Reading youth form sheet...")
     self.responses = {}
-    service = authenticate_service_account()
-    file_id = secret("youth_form_response_file_id")
-    data = read_sheet_data(service, file_id)
+    if data is None:
+      data = YouthFormResponses.read_sheet_data()
     map = self.column_map()
     responses = [self.transform_row({map[i]: val for i, val in enumerate(row)}) for row in data if self.row_looks_legit(row)]
     responses = [response for response in responses if response.get("override", "").lower() != "ignore"]
@@ -9,6 +9,7 @@ from log.logger import log
 from util.secrets import secret
 
 from datasources.data_source_manager import DataSourceManager
+from integrations.database import Database
 from integrations.google_api import authenticate_service_account, upload_csv_to_drive
 
 # TODO: consolidate this with other report classes into a common subclass that does common parts of latest/download and other operations
@@ -101,10 +102,11 @@ class TDList:
       
   def apply(self, badgefile):
     log.debug(f"td_list: Merging data from TD list into attendees")
-    for tdlist_info in self.rows():
-      attendee = badgefile.lookup_attendee(tdlist_info['aga_id'])
-      if attendee is not None:
-        attendee.merge_tdlist_info(tdlist_info)
+    with Database.shared().batch():
+      for tdlist_info in self.rows():
+        attendee = badgefile.lookup_attendee(tdlist_info['aga_id'])
+        if attendee is not None:
+          attendee.merge_tdlist_info(tdlist_info)
     log.debug("td_list: done merging")
   
   # TODO: this appears in 3 places without alteration. REALLY should have a common util class in this project!
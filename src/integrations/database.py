@@ -1,27 +1,194 @@
 import sqlite3
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional
 import os
+import queue
+import threading
 import time
+from contextlib import contextmanager
 
 from log.logger import log
+from util.secrets import secret
+
+class ConnectionPool:
+  """Hands out a bounded set of sqlite connections to one database file. Database checks a connection out around each
+  statement (or for the length of a batch) and checks it back in afterwards, so the number of open connections doesn't
+  grow with the number of threads."""
+
+  def __init__(self, path, profile):
+    self.path = path
+    self.profile = profile
+    self.size = profile["pool_size"]
+    self._idle = queue.LifoQueue()
+    self._lock = threading.Lock()
+    self._num_open = 0
+    self._stats = {"checkouts": 0, "hits": 0, "opened": 0, "waits": 0, "wait_time": 0.0, "timeouts": 0}
+
+  def connect(self):
+    conn = sqlite3.connect(self.path, timeout=self.profile["busy_timeout"] / 1000.0, check_same_thread=False)
+    conn.row_factory = sqlite3.Row  # Allows rows to be accessed as dictionaries
+    self.apply_profile(conn)
+    return conn
+
+  def apply_profile(self, conn):
+    """Apply the connection profile's PRAGMAs to a connection. Called once, when the connection is opened."""
+
+    profile = self.profile
+    cursor = conn.cursor()
+    journal_mode = cursor.execute(f"PRAGMA journal_mode={profile['journal_mode']};").fetchone()[0]
+    if journal_mode.lower() != str(profile['journal_mode']).lower():
+      log.warn(f"Requested journal_mode {profile['journal_mode']} for {self.path}, but sqlite is using {journal_mode}")
+
+    for pragma in ["synchronous", "busy_timeout", "mmap_size", "cache_size", "temp_store"]:
+      cursor.execute(f"PRAGMA {pragma}={profile[pragma]};")
+
+  def checkout(self):
+    start_time = time.time()
+    conn = None
+    opened = False
+    waited = False
+
+    try:
+      conn = self._idle.get_nowait()
+    except queue.Empty:
+      with self._lock:
+        opened = self._num_open < self.size
+        if opened:
+          self._num_open += 1
+
+      if opened:
+        try:
+          conn = self.connect()
+        except Exception:
+          with self._lock:
+            self._num_open -= 1
+          raise
+      else:
+        waited = True
+        try:
+          conn = self._idle.get(timeout=self.profile["pool_timeout"])
+        except queue.Empty:
+          with self._lock:
+            self._stats["timeouts"] += 1
+          log.error(f"Timed out after {self.profile['pool_timeout']}s waiting for a database connection; {self.summary()}")
+          raise
+
+    wait_time = time.time() - start_time
+    with self._lock:
+      self._stats["checkouts"] += 1
+      self._stats["hits"] += 0 if (opened or waited) else 1
+      self._stats["opened"] += 1 if opened else 0
+      self._stats["waits"] += 1 if waited else 0
+      self._stats["wait_time"] += wait_time if waited else 0.0
+      checkouts = self._stats["checkouts"]
+
+    if waited and wait_time > 1.0:
+      log.info(f"Waited {wait_time*1000:.1f} ms for a database connection; {self.summary()}")
+    if checkouts % self.profile["pool_report_interval"] == 0:
+      log.debug(f"Database pool: {self.summary()}")
+    return conn
+
+  def checkin(self, conn):
+    if conn.in_transaction:
+      # whoever had this connection left a transaction open (e.g. a statement failed mid-write); don't hand it on
+      conn.rollback()
+    self._idle.put(conn)
+
+  def stats(self):
+    with self._lock:
+      stats = self._stats.copy()
+      stats["size"] = self.size
+      stats["open"] = self._num_open
+    stats["idle"] = self._idle.qsize()
+    stats["hit_rate"] = stats["hits"] / stats["checkouts"] if stats["checkouts"] > 0 else 0.0
+    return stats
+
+  def summary(self):
+    stats = self.stats()
+    avg_wait_ms = 1000 * stats["wait_time"] / stats["waits"] if stats["waits"] > 0 else 0.0
+    return f"{stats['open']}/{stats['size']} connections open, {stats['idle']} idle; {stats['checkouts']} checkouts, " \
+           f"{100*stats['hit_rate']:.1f}% hit rate, {stats['waits']} waits (avg {avg_wait_ms:.1f} ms), {stats['timeouts']} timeouts"
 
 class Database:
   """Provides a convenience wrapper for database operations."""
 
   _shared = None
+  _schema = {} # (path, table_name) -> set of known column names; shared by every thread's connection
+  _schema_lock = threading.Lock()
+  _statements = {} # cached SQL text, keyed by whatever the caller says the statement depends on
+
+  # connection settings applied to every new connection. override any of these with a 'database_profile' dict in secrets.yaml.
+  DEFAULT_PROFILE = {
+    "journal_mode": "WAL",       # readers and the writer don't block each other
+    "synchronous": "NORMAL",     # safe with WAL; only fsyncs at checkpoints
+    "busy_timeout": 5000,        # ms sqlite waits on a locked database before raising "database is locked"
+    "mmap_size": 268435456,      # bytes
+    "cache_size": -65536,        # negative values are KiB, so 64 MiB
+    "temp_store": "MEMORY",
+    "max_attempts": 3,           # attempts per statement if we still get a locked/busy error after busy_timeout
+    "retry_delay": 0.05,         # seconds before the first retry; doubles on each subsequent retry
+    "pool_size": 8,              # maximum open connections per database file
+    "pool_timeout": 30,          # seconds to wait for a free connection before giving up
+    "pool_report_interval": 1000, # log pool stats every this many checkouts
+  }
+
+  _pools = {} # path -> ConnectionPool
+  _pools_lock = threading.Lock()
+  _thread_instances = {} # thread ident -> Database
+  _thread_instances_lock = threading.Lock()
+
+  _contention_lock = threading.Lock()
+  _contention_stats = {"lock_errors": 0, "retries": 0, "failures": 0}
+
+  @classmethod
+  def profile(cls):
+    profile = cls.DEFAULT_PROFILE.copy()
+    profile.update(secret("database_profile", {}) or {})
+    return profile
+
+  @classmethod
+  def contention_stats(cls):
+    with cls._contention_lock:
+      return cls._contention_stats.copy()
+
+  @classmethod
+  def _record_contention(cls, **counts):
+    with cls._contention_lock:
+      for key, count in counts.items():
+        cls._contention_stats[key] += count
+      return cls._contention_stats.copy()
+
+  @classmethod
+  def pool(cls, path):
+    with cls._pools_lock:
+      if path not in cls._pools:
+        cls._pools[path] = ConnectionPool(path, cls.profile())
+      return cls._pools[path]
 
   @classmethod
   def shared(cls):
-    import threading
-    thread_id = threading.get_ident()
-    
-    if not hasattr(cls, '_thread_instances'):
-      cls._thread_instances = {}
-    
-    if thread_id not in cls._thread_instances:
-      cls._thread_instances[thread_id] = Database("badgefile.sqlite3")
-    
-    return cls._thread_instances[thread_id]
+    # each thread gets its own Database, which tracks that thread's batch state. connections themselves come from
+    # the shared pool, so these are cheap, and we drop the ones belonging to threads that have exited.
+    thread = threading.current_thread()
+
+    with cls._thread_instances_lock:
+      instance = cls._thread_instances.get(thread.ident)
+      if instance is not None and instance._thread is thread:
+        return instance
+
+      cls._prune_dead_threads()
+      instance = Database("badgefile.sqlite3")
+      cls._thread_instances[thread.ident] = instance
+      return instance
+
+  @classmethod
+  def _prune_dead_threads(cls):
+    # thread idents get reused, so an instance is stale if its thread has exited or its ident now belongs to someone else
+    live_threads = {thread.ident: thread for thread in threading.enumerate()}
+    stale = [ident for ident, instance in cls._thread_instances.items() if live_threads.get(ident) is not instance._thread]
+    for ident in stale:
+      cls._thread_instances.pop(ident).release()
+    if len(stale) > 0:
+      log.trace(f"Released {len(stale)} database handles for exited threads; {len(cls._thread_instances)} remaining")
   
   def __init__(self, path: str):
     """
@@ -30,7 +197,44 @@ class Database:
     :param path: Path to the SQLite database file.
     """
     self.path = path
-    self.conn = sqlite3.connect(self.path)
+    self._profile = Database.profile()
+    self._pool = Database.pool(path)
+    self._thread = threading.current_thread()
+    self._conn = None # connection held for the duration of a batch
+    self._batch_depth = 0
+    self._pending = [] # list of [sql, [params, ...]] queued by execute_batched, in the order they were issued
+    self._schema_changes = set() # schema registry keys of tables created or altered inside the current batch
+    self._rollback_hooks = [] # callbacks registered with on_rollback during the current batch
+
+  @contextmanager
+  def connection(self):
+    """Check out a pooled connection for the duration of a block, or use the one held by the current batch."""
+
+    if self._conn is not None:
+      yield self._conn
+      return
+
+    conn = self._pool.checkout()
+    try:
+      yield conn
+    finally:
+      self._pool.checkin(conn)
+
+  def release(self):
+    """Return any connection this instance is holding to the pool, abandoning an unfinished batch."""
+
+    if self._conn is not None:
+      log.warn(f"Releasing database connection held by exited thread {self._thread.name}; uncommitted batch will be rolled back")
+      conn, self._conn = self._conn, None
+      self._pending = []
+      self._batch_depth = 0
+      self.forget_schema_changes()
+      self.run_rollback_hooks()
+      self._pool.checkin(conn)
+
+  @classmethod
+  def pool_stats(cls, path="badgefile.sqlite3"):
+    return cls.pool(path).stats()
 
   def query(self, sql: str, params: Optional[List[Any]] = None) -> List[Dict[str, Any]]:
     """
@@ -43,27 +247,54 @@ class Database:
 
     if params is None:
       params = []
-    self.conn.row_factory = sqlite3.Row  # Allows rows to be accessed as dictionaries
-    cursor = self.conn.cursor()
-    retry = 0
+    self.flush()
 
-    while True:
-      retry += 1
-      try:
+    with self.connection() as conn:
+      cursor = conn.cursor()
+      def run():
         cursor.execute(sql, params)
         return [dict(row) for row in cursor.fetchall()]
-      except sqlite3.OperationalError as exc:
-        if retry < 3:
-          log.debug("Caught exception on attempt #{retry}/3 of query '#{sql}'; retrying", exception=exc)
-          time.sleep(0.001)
-        else:
-          log.error("Unable to execute query '#{sql}'", exception=exc)
-          raise exc
-    
+      return self._with_retries(sql, run)
+
+  ROW_FACTORIES = ["dict", "tuple", "row"]
+
+  def iter_query(self, sql: str, params: Optional[List[Any]] = None, row_factory: str = "dict", batch_size: int = 500) -> Iterator[Any]:
+    """
+    Execute a SELECT query and yield its rows one at a time, fetching them from sqlite batch_size at a time, so the
+    whole result set is never held in memory. A pooled connection is held until the iterator is exhausted or closed.
+
+    :param sql: SQL query string (SELECT statement).
+    :param params: Optional list of parameters for the query.
+    :param row_factory: "dict" (as returned by query), "tuple", or "row" (sqlite3.Row, indexable by name or position).
+    :param batch_size: Number of rows to fetch from sqlite at once.
+    :return: Iterator over rows.
+    """
+
+    if params is None:
+      params = []
+    if row_factory not in self.ROW_FACTORIES:
+      raise ValueError(f"Unknown row_factory '{row_factory}'; expected one of {self.ROW_FACTORIES}")
+    self.flush()
+
+    with self.connection() as conn:
+      cursor = conn.cursor()
+      if row_factory == "tuple":
+        cursor.row_factory = None
+      try:
+        self._with_retries(sql, lambda: cursor.execute(sql, params))
+        while True:
+          rows = cursor.fetchmany(batch_size)
+          if len(rows) == 0:
+            break
+          for row in rows:
+            yield dict(row) if row_factory == "dict" else row
+      finally:
+        cursor.close()
 
   def execute(self, sql: str, params: Optional[List[Any]] = None) -> int:
     """
     Execute a non-SELECT query and return the number of rows affected.
+    Commits immediately, unless called inside batch().
 
     :param sql: SQL query string (INSERT, UPDATE, DELETE, CREATE TABLE, etc.).
     :param params: Optional list of parameters for the query.
@@ -72,25 +303,225 @@ class Database:
 
     if params is None:
       params = []
-    cursor = self.conn.cursor()
-
-    retry = 0
+    self.flush()
 
-    while True:
-      retry += 1
-      try:
+    with self.connection() as conn:
+      cursor = conn.cursor()
+      def run():
         cursor.execute(sql, params)
         self._last_id = cursor.lastrowid
-        self.conn.commit()
+        if not self.in_batch():
+          conn.commit()
         return cursor.rowcount
+      return self._with_retries(sql, run)
+
+  def executemany(self, sql: str, param_list: List[List[Any]]) -> int:
+    """
+    Execute a non-SELECT query once for each set of parameters, and return the total number of rows affected.
+    Commits immediately, unless called inside batch().
+
+    :param sql: SQL query string (INSERT, UPDATE, DELETE, etc.).
+    :param param_list: List of parameter lists, one per execution.
+    :return: Total number of rows affected.
+    """
+
+    if len(param_list) == 0:
+      return 0
+    self.flush()
+
+    with self.connection() as conn:
+      cursor = conn.cursor()
+      def run():
+        cursor.executemany(sql, param_list)
+        if not self.in_batch():
+          conn.commit()
+        return cursor.rowcount
+      return self._with_retries(sql, run)
+
+  def execute_batched(self, sql: str, params: Optional[List[Any]] = None):
+    """
+    Execute a non-SELECT query whose row count isn't needed. Inside batch(), the statement is queued, and consecutive
+    statements with the same SQL are run together with executemany; outside a batch, this is the same as execute().
+
+    :param sql: SQL query string (INSERT, UPDATE, DELETE, etc.).
+    :param params: Optional list of parameters for the query.
+    """
+
+    if params is None:
+      params = []
+    if not self.in_batch():
+      self.execute(sql, params)
+      return
+
+    if len(self._pending) > 0 and self._pending[-1][0] == sql:
+      self._pending[-1][1].append(params)
+    else:
+      self._pending.append([sql, [params]])
+
+  def flush(self):
+    """
+    Run any statements queued by execute_batched. Called automatically before any other query or statement,
+    so reads inside a batch always see earlier writes.
+    """
+
+    while len(self._pending) > 0:
+      sql, param_list = self._pending.pop(0)
+      with self.connection() as conn:
+        cursor = conn.cursor()
+        self._with_retries(sql, lambda: cursor.executemany(sql, param_list))
+
+  def in_batch(self):
+    return self._batch_depth > 0
+
+  @contextmanager
+  def batch(self):
+    """
+    Group writes into a single transaction, e.g. `with Database.shared().batch():`. Inside a batch, execute() does
+    not commit and execute_batched() defers its statements. Everything is committed when the outermost batch exits,
+    or rolled back if it exits with an exception. Batches may be nested.
+    """
+
+    if self._batch_depth == 0:
+      self._conn = self._pool.checkout() # hold one connection for the whole transaction
+      self._schema_changes = set()
+      self._rollback_hooks = []
+    self._batch_depth += 1
+    try:
+      yield self
+      if self._batch_depth == 1:
+        self.flush()
+        self._with_retries("COMMIT", self._conn.commit)
+        self._schema_changes = set()
+        self._rollback_hooks = []
+    except Exception:
+      if self._batch_depth == 1:
+        self._pending = []
+        self._conn.rollback()
+        self.forget_schema_changes()
+        self.run_rollback_hooks()
+      raise
+    finally:
+      self._batch_depth -= 1
+      if self._batch_depth == 0 and self._conn is not None:
+        conn, self._conn = self._conn, None
+        self._pool.checkin(conn)
+
+  def on_rollback(self, callback):
+    """
+    Call callback() if the current batch is rolled back, e.g. to undo in-memory state that assumed its writes would
+    stick. Callbacks run newest first. Outside a batch, writes commit immediately, so this does nothing.
+
+    :param callback: Function taking no arguments
+    """
+
+    if self.in_batch():
+      self._rollback_hooks.append(callback)
+
+  def run_rollback_hooks(self):
+    hooks, self._rollback_hooks = self._rollback_hooks, []
+    for callback in reversed(hooks):
+      try:
+        callback()
+      except Exception as exc:
+        log.error("Encountered exception running database rollback hook", exception=exc)
+
+  # DDL run by ensure_table/ensure_columns inside a batch is rolled back with it, so drop what the schema registry
+  # learned about those tables (and only those); the next ensure_table/ensure_columns reloads them from the database
+  def forget_schema_changes(self):
+    if len(self._schema_changes) == 0:
+      return
+    with Database._schema_lock:
+      for key in self._schema_changes:
+        Database._schema.pop(key, None)
+    self._schema_changes = set()
+
+  def _with_retries(self, sql, operation):
+    max_attempts = self._profile["max_attempts"]
+    attempt = 0
+
+    while True:
+      attempt += 1
+      try:
+        return operation()
       except sqlite3.OperationalError as exc:
-        if retry < 3:
-          log.debug("Caught exception on attempt #{retry}/3 of query '#{sql}'; retrying", exception=exc)
-          time.sleep(0.001)
+        # sqlite has already waited busy_timeout for the lock by the time we get here, so this is real contention
+        is_contention = "locked" in str(exc) or "busy" in str(exc)
+        if is_contention and attempt < max_attempts:
+          stats = Database._record_contention(lock_errors=1, retries=1)
+          log.info(f"Database locked on attempt #{attempt}/{max_attempts} of statement '{sql}'; retrying ({stats['lock_errors']} lock errors, {stats['retries']} retries so far)", exception=exc)
+          time.sleep(self._profile["retry_delay"] * (2 ** (attempt - 1)))
         else:
-          log.error(f"Encountered exception executing statement #{sql}", data=sql, exception=exc)
+          stats = Database._record_contention(lock_errors=1 if is_contention else 0, failures=1)
+          log.error(f"Encountered exception executing statement '{sql}' after {attempt} attempt(s) ({stats['lock_errors']} lock errors, {stats['failures']} failures so far)", data=sql, exception=exc)
           raise exc
   
+  def ensure_table(self, table_name, create_sql):
+    """
+    Run a CREATE TABLE IF NOT EXISTS statement, once per table per process. The table's columns are loaded into the
+    process-wide schema registry used by ensure_columns.
+
+    :param table_name: Name of the table, string
+    :param create_sql: CREATE TABLE IF NOT EXISTS statement for the table
+    """
+
+    key = (self.path, table_name)
+    if key in Database._schema:
+      return
+
+    with Database._schema_lock:
+      if key in Database._schema:
+        return
+      self.execute(create_sql)
+      Database._schema[key] = set(self.columns_of_table(table_name))
+      if self.in_batch():
+        self._schema_changes.add(key)
+
+  def ensure_columns(self, table_name, column_definitions):
+    """
+    Make sure a table created with ensure_table has the given columns, issuing ALTER TABLE ADD COLUMN only for columns
+    we haven't already seen. Columns are checked against the schema registry, so this doesn't touch the database
+    unless a new column actually appears.
+
+    :param table_name: Name of the table, string
+    :param column_definitions: List of [name, type] pairs
+    """
+
+    key = (self.path, table_name)
+    known_columns = Database._schema.get(key)
+    if known_columns is not None and all(defn[0] in known_columns for defn in column_definitions):
+      return
+
+    with Database._schema_lock:
+      # another thread or process may have added these columns since we last looked, or a rolled-back batch may have
+      # made us forget the table entirely
+      known_columns = Database._schema.setdefault(key, set())
+      known_columns.update(self.columns_of_table(table_name))
+      for name, type in column_definitions:
+        if name in known_columns:
+          continue
+        log.debug(f"Adding column {name} of type {type} to {table_name}")
+        self.execute(f"ALTER TABLE {table_name} ADD COLUMN {name} {type} DEFAULT NULL;")
+        known_columns.add(name)
+        if self.in_batch():
+          self._schema_changes.add(key)
+
+  def cached_statement(self, key, build):
+    """
+    Return SQL text for a statement, building it with build() the first time a given key is seen. Use a key that
+    captures everything the SQL depends on (e.g. table name and column list), so hot save paths don't rebuild the
+    same statement text over and over.
+
+    :param key: Hashable key identifying the statement
+    :param build: Function returning the SQL text
+    :return: SQL text
+    """
+
+    sql = Database._statements.get(key)
+    if sql is None:
+      sql = build()
+      Database._statements[key] = sql
+    return sql
+
   def columns_of_table(self, table_name):
     """
     Return a list of columns of a given table.
@@ -99,9 +530,10 @@ class Database:
     :return: A list of string names of columns in the table
     """
 
-    cursor = self.conn.cursor()
-    cursor.execute(f"PRAGMA table_info({table_name});")
-    columns = [row[1] for row in cursor.fetchall()]
+    with self.connection() as conn:
+      cursor = conn.cursor()
+      cursor.execute(f"PRAGMA table_info({table_name});")
+      columns = [row[1] for row in cursor.fetchall()]
     return columns
   
   def last_id(self):
@@ -1,14 +1,13 @@
+import copy
 import hashlib
-import os
-import importlib.util
 import json
-import sys
 import hmac
+import time
 from datetime import datetime
-from pathlib import Path
 
 from integrations.database import Database
 from .issue_manager import IssueManager
+from .issue_check_registry import IssueCheckRegistry
 from .id_manager import IdManager
 from datasources.clubexpress.reglist import Reglist
 from datasources.clubexpress.activity_list import ActivityList
@@ -24,11 +23,26 @@ from log.logger import log
 class Attendee:
   """Describes a single attendee at the Congress. Combines data from multiple datasources to present a cohesive view of each attendee."""
 
+  # process-wide counts of sync_to_db calls, to see how much write load an update cycle produces
+  _sync_stats = {"rows_written": 0, "columns_written": 0, "syncs_skipped": 0}
+
+  @classmethod
+  def sync_stats(cls):
+    return cls._sync_stats.copy()
+
+  @classmethod
+  def reset_sync_stats(cls):
+    for key in cls._sync_stats:
+      cls._sync_stats[key] = 0
+
   def __init__(self, badgefile):
     self._info = {}
+    self._synced_info = {} # copy of _info as of the last load from or sync to the database; see dirty_keys()
     self._badgefile = badgefile
     self._activities = None
     self._issues = None
+    self._parsed_issues = None
+    self._issues_by_category = None
     pass
 
   def badgefile(self):
@@ -52,6 +66,7 @@ class Attendee:
 
   def load_db_row(self, row):
     self._info.update(row)
+    self.mark_clean()
     return self
   
   def effective_rank(self):
@@ -458,48 +473,106 @@ class Attendee:
       self._info[key] = value
     self.sync_to_db()
   
+  # return a copy of this attendee for running issue checks on a worker thread; see AttendeeSnapshot
+  def snapshot(self):
+    return AttendeeSnapshot(self)
+
+  # snapshot our info as it currently stands in the database
+  def mark_clean(self):
+    self._synced_info = {key: copy.deepcopy(value) for key, value in self._info.items() if key != 'json'}
+
+  # mark_clean after writing our info. inside a batch, the write doesn't stick unless the batch commits, so go back to
+  # the previous snapshot if it's rolled back, and the changes will be written again on the next sync.
+  def mark_synced(self):
+    previous = self._synced_info
+    self.mark_clean()
+    Database.shared().on_rollback(lambda: setattr(self, '_synced_info', previous))
+
+  # return a list of keys in our info that have been added, changed or removed since we were loaded or last synced
+  def dirty_keys(self):
+    dirty = [key for key in self._info if key != 'json' and (key not in self._synced_info or not self.same_value(self._info[key], self._synced_info[key]))]
+    dirty += [key for key in self._synced_info if key not in self._info]
+    return dirty
+
+  @staticmethod
+  def same_value(a, b):
+    if a == b:
+      return True
+    # columns created as TEXT hand numbers back to us as strings (e.g. aga_rating after a reload), so don't count
+    # the TD list or reglist giving us the same number again as a change.
+    numeric = (int, float)
+    if isinstance(a, str) and isinstance(b, numeric) and not isinstance(b, bool):
+      return a == str(b)
+    if isinstance(b, str) and isinstance(a, numeric) and not isinstance(a, bool):
+      return b == str(a)
+    return False
+
   def sync_to_db(self, existing_id=None):
     if existing_id is None:
       existing_id = self.id()
 
-    self.ensure_attendee_table()
     info = self.info()
     if 'json' in info:
       del(info['json'])
 
-    keys = [defn[0] for defn in self.column_definitions()]
-    set_clause = "badgefile_id=?, json=?, " + ", ".join([f"{key}=?" for key in keys])
+    dirty = set(self.dirty_keys())
+    if existing_id == self.id() and len(dirty) == 0:
+      Attendee._sync_stats["syncs_skipped"] += 1
+      return
+
+    column_defns = self.column_definitions()
+    self.ensure_attendee_table(column_defns)
+
+    keys = tuple(defn[0] for defn in column_defns)
+    db = Database.shared()
+
+    if existing_id == self.id():
+      # usual case: our badgefile_id hasn't changed, so an upsert covers both new and existing rows. we don't need
+      # the affected row count, so this can be deferred and grouped with other writes if we're inside Database.batch().
+      # only the columns that changed are written, along with the json blob.
+      keys = tuple(key for key in keys if key in dirty)
+      def build_upsert():
+        columns = ["badgefile_id", "json"] + list(keys)
+        return f"INSERT INTO Attendees ({', '.join(columns)}) VALUES ({', '.join(['?' for _ in columns])}) " \
+               f"ON CONFLICT(badgefile_id) DO UPDATE SET {', '.join([f'{col}=excluded.{col}' for col in columns[1:]])}"
+      upsert_args = [self.id(), json.dumps(info)] + [info[key] for key in keys]
+      db.execute_batched(db.cached_statement(("Attendees", "upsert", keys), build_upsert), upsert_args)
+      self.mark_synced()
+      Attendee._sync_stats["rows_written"] += 1
+      Attendee._sync_stats["columns_written"] += len(keys)
+      return
+
     base_args = [self.id(), json.dumps(info)] + [info[key] for key in keys]
-    update_args = base_args + [existing_id]
 
-    update_sql = f"UPDATE Attendees SET {set_clause} WHERE badgefile_id=?"
-    affected_rows = Database.shared().execute(update_sql, update_args)
+    update_args = base_args + [existing_id]
+    update_sql = db.cached_statement(("Attendees", "update", keys),
+      lambda: f"UPDATE Attendees SET badgefile_id=?, json=?, {', '.join([f'{key}=?' for key in keys])} WHERE badgefile_id=?")
+    affected_rows = db.execute(update_sql, update_args)
 
     if affected_rows == 0:
-      insert_sql = f"INSERT INTO Attendees (badgefile_id, json, {','.join(keys)}) VALUES (?, ?, {', '.join(['?' for _ in keys])})"
+      insert_sql = db.cached_statement(("Attendees", "insert", keys),
+        lambda: f"INSERT INTO Attendees (badgefile_id, json, {','.join(keys)}) VALUES (?, ?, {', '.join(['?' for _ in keys])})")
       try:
-        Database.shared().execute(insert_sql, base_args)
+        db.execute(insert_sql, base_args)
       except Exception as exc:
         log.error(f"Failed SQL:\n{insert_sql}\n{base_args}")
         raise(exc)
 
+    self.mark_synced()
+    Attendee._sync_stats["rows_written"] += 1
+    Attendee._sync_stats["columns_written"] += len(keys)
+
     if existing_id != self.id():
       # TODO: placeholder. we're going to want a column for the primary registrant's badgefile id.
       # if we changed someone's bfid, we need to make sure everyone who listed them as a primary registrant is updated to match.
       pass
   
-  def ensure_attendee_table(self):
-    Database.shared().execute("CREATE TABLE IF NOT EXISTS Attendees(badgefile_id INTEGER NOT NULL PRIMARY KEY, json TEXT NOT NULL)")
-    defns_dict = { col[0]: col[1] for col in self.column_definitions() }
-    existing_cols = Database.shared().columns_of_table("Attendees")
-    expected_cols = defns_dict.keys()
-    missing_columns = list(set(expected_cols) - set(existing_cols))
-    missing_defns = [[col, defns_dict[col]] for col in missing_columns if col in defns_dict]
-    
-    for defn in missing_defns:
-      name, type = defn
-      query = f"ALTER TABLE Attendees ADD COLUMN {name} {type} DEFAULT NULL;"
-      Database.shared().execute(query)
+  def ensure_attendee_table(self, column_defns=None):
+    # the table and its known columns are cached in Database's schema registry, so this only hits the database
+    # the first time through, or when info has a key we haven't seen before.
+    db = Database.shared()
+    db.ensure_table("Attendees", "CREATE TABLE IF NOT EXISTS Attendees(badgefile_id INTEGER NOT NULL PRIMARY KEY, json TEXT NOT NULL)")
+    db.ensure_columns("Attendees", column_defns if column_defns is not None else self.column_definitions())
 
   def column_definitions(self):
     return self.implicit_column_definitions() + self.explicit_column_definitions()
@@ -515,7 +588,8 @@ class Attendee:
     # remove anything that is a list or dict; those can't go into the sqlite table
     implicit_keys = [k for k in implicit_keys if not isinstance(info[k], (list, dict))]
 
-    return [ [key, "INTEGER" if isinstance(info[key], int) else "TEXT"] for key in implicit_keys ]
+    # sorted, so the same set of keys always produces the same column list (and the same cached SQL)
+    return [ [key, "INTEGER" if isinstance(info[key], int) else "TEXT"] for key in sorted(implicit_keys) ]
 
   def explicit_column_definitions(self):
     return [
@@ -609,6 +683,29 @@ class Attendee:
 
     return sha256_hash
 
+  # groups of fields that similarity_score tests on. any attendee with a nonzero similarity score for a reglist row
+  # shares at least one of these keys with it, so these narrow down which attendees are worth scoring.
+  SIMILARITY_BLOCKING_FIELDS = [
+    ["aga_id"],
+    ["name_family", "name_given"],
+    ["phone_mobile"],
+    ["addr1", "postcode"],
+    ["name_family", "date_of_birth"],
+  ]
+
+  # return the blocking keys for an attendee's info, or for a reglist row (for_row=True). these mirror the comparison
+  # in similarity_score: rows can't match on None values, but attendees' None values compare as the string "none".
+  @classmethod
+  def similarity_blocking_keys(cls, info, for_row=False):
+    keys = []
+    for fields in cls.SIMILARITY_BLOCKING_FIELDS:
+      if any(field not in info for field in fields):
+        continue
+      if for_row and any(info[field] is None for field in fields):
+        continue
+      keys.append(tuple(fields) + tuple(str(info[field]).lower() for field in fields))
+    return keys
+
   # calculate the heuristic similarity between this attendee and the attendee described
   # in a registrant data row    
   def similarity_score(self, row):
@@ -651,78 +748,149 @@ class Attendee:
   # return a dict of previously identified issues that are not marked as resolved in the database
   def open_issues(self, force=False):
     if self._issues is None or force:
-      self._issues = IssueManager.shared().open_issues_for_attendee(self)
+      self.set_open_issues(IssueManager.shared().open_issues_for_attendee(self))
     return self._issues
 
+  # supply this attendee's open issues (issue_type -> issue data JSON), e.g. from IssueManager.open_issues_by_badgefile_id,
+  # so that open_issues doesn't need to query for them
+  def set_open_issues(self, issues):
+    self._issues = issues
+    self._parsed_issues = None
+    self._issues_by_category = None
+
+  # return the same issues as open_issues, with each issue's data already parsed from JSON. parsed once per scan; callers
+  # must not modify the returned issues.
+  def parsed_open_issues(self):
+    if self._parsed_issues is None:
+      self._parsed_issues = {issue_type: json.loads(issue_raw) for issue_type, issue_raw in self.open_issues().items()}
+    return self._parsed_issues
+
+  # return a dict of category -> list of parsed open issues in that category
+  def issues_by_category(self):
+    if self._issues_by_category is None:
+      by_category = {}
+      for issue in self.parsed_open_issues().values():
+        if 'category' not in issue:
+          log.error(f"ERROR: Issue for attendee {self.id()} {self.full_name()} missing 'category' field: {issue}")
+        by_category.setdefault(issue.get('category'), []).append(issue)
+      self._issues_by_category = by_category
+    return self._issues_by_category
+
   # return a list of previously identified issues regardless of status
   def all_issues(self):
     # TODO: Strongly consider memoizing this!!
     return IssueManager.shared().all_issues_for_attendee(self)
 
-  # scan for new issues and insert them into the database if no similar issue is open for this user;
-  # mark previous issues as resolved if the issue has been corrected.
-  def scan_issues(self):
-    if self.is_manual():
-      return {}
-    
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    issue_dir = os.path.join(script_dir, "issue_checks")
+  # run every issue check against this attendee and return a dict of issue_type -> issue data, without touching the
+  # Issues table. if timings is supplied, each check's run count and total time are accumulated into it as
+  # issue_type -> [runs, total_ms].
+  #
+  # if fingerprints is supplied (issue_type -> fingerprint of the check's inputs at the last scan), checks whose
+  # inputs haven't changed since are skipped, and their open issue (if any) is carried forward. fingerprints is
+  # updated in place with the current fingerprint of every check that declares its inputs.
+  def run_issue_checks(self, timings=None, fingerprints=None):
     current_issues = {}
+    if self.is_cancelled():
+      # only run the issue check scripts for non-cancelled attendees
+      # (thus cancelled attendees have no outstanding issues)
+      return current_issues
 
-    project_root = Path(__file__).resolve().parent.parent.parent
-    sys.path.append(str(project_root))
-
+    input_hashes = {}
+    for check in IssueCheckRegistry.shared().checks():
+      try:
+        if fingerprints is not None and check.inputs is not None:
+          fingerprint = self.issue_check_fingerprint(check, input_hashes)
+          if fingerprints.get(check.issue_type) == fingerprint:
+            previous = self.parsed_open_issues().get(check.issue_type)
+            if previous is not None:
+              current_issues[check.issue_type] = previous
+            continue
+          fingerprints[check.issue_type] = fingerprint
+
+        start_check_time = time.perf_counter()
+        issue_data = check.run_check(self)
+      except Exception as exc:
+        # one broken check shouldn't sink the whole scan. leave its issue as it was, and forget the new fingerprint
+        # so the check runs again next scan.
+        log.error(f"Issue check {check.issue_type} failed for attendee {self.full_name()} {self.id()}", exception=exc)
+        if fingerprints is not None:
+          fingerprints.pop(check.issue_type, None)
+        previous = self.parsed_open_issues().get(check.issue_type)
+        if previous is not None:
+          current_issues[check.issue_type] = previous
+        continue
+      check_time_ms = (time.perf_counter() - start_check_time) * 1000
+      if timings is not None:
+        timing = timings.setdefault(check.issue_type, [0, 0.0])
+        timing[0] += 1
+        timing[1] += check_time_ms
+      if check_time_ms > 5.0:
+        log.debug(f"Issue check {check.issue_type} execution completed in {check_time_ms:.2f} ms")
+      if issue_data is not None:  # Only collect non-None results
+        current_issues[check.issue_type] = issue_data
 
-    if not self.is_cancelled():
-      # Run all the issue check scripts, but only for non-cancelled attendees
-      # (thus cancelled attendees have no outstanding issues)
-      import time
-      
-      for filename in os.listdir(issue_dir):
-        if "__" in filename:
-          continue
-        if filename.endswith(".py"):
-          file_path = os.path.join(issue_dir, filename)
-          
-          # Measure import time
-          start_import_time = time.time()
-          
-          # Dynamically import the script
-          issue_type = filename[:-3]  # Strip .py extension
-          spec = importlib.util.spec_from_file_location(issue_type, file_path)
-          module = importlib.util.module_from_spec(spec)
-          spec.loader.exec_module(module)
-          
-          import_time_ms = (time.time() - start_import_time) * 1000
-          
-          # Check for a function named 'run_check' and execute it
-          if hasattr(module, "run_check"):
-            start_check_time = time.time()
-            issue_data = module.run_check(self)
-            check_time_ms = (time.time() - start_check_time) * 1000
-            total_time_ms = import_time_ms + check_time_ms
-            if total_time_ms > 5.0:
-              log.debug(f"Issue check {issue_type} execution completed in {check_time_ms:.2f} ms (total: {total_time_ms:.2f} ms)")
-            if issue_data is not None:  # Only collect non-None results
-              current_issues[issue_type] = issue_data
-          elif total_time_ms > 5.0:
-            log.debug(f"Issue check {issue_type} has no run_check function (import only: {import_time_ms:.2f} ms)")
+    return current_issues
 
+  # return a hash of the given check's declared inputs for this attendee, and of the check itself, so a change to
+  # either one causes the check to be re-run. input_hashes memoizes each input's hash across the checks in one scan.
+  def issue_check_fingerprint(self, check, input_hashes):
+    for input in check.inputs:
+      if input not in input_hashes:
+        input_hashes[input] = self.issue_check_input_hash(input)
+    parts = [check.issue_type, str(check.mtime)] + [f"{input}={input_hashes[input]}" for input in sorted(check.inputs)]
+    return hashlib.sha256("|".join(parts).encode('utf-8')).hexdigest()
+
+  # return a hash of one of the IssueCheckRegistry.INPUTS for this attendee
+  def issue_check_input_hash(self, input):
+    def hash_of(value):
+      return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    if input == "info":
+      return hash_of([self.datahash(), LocalAttendeeOverrides.shared().data.get(self.id(), {})])
+    elif input == "party":
+      primary = self.primary()
+      members = self._badgefile.parties().get(primary, []) + [primary]
+      return hash_of(sorted([member.id(), member.datahash()] for member in members if member is not None))
+    elif input == "activities":
+      primary = self.primary()
+      activities = self.activities() + (primary.activities() if primary is not None and primary is not self else [])
+      return hash_of(sorted([activity.info() for activity in activities], key=lambda info: json.dumps(info, sort_keys=True, default=str)))
+    elif input == "payments":
+      return hash_of([self.congress_payment_lines(), self.housing_payment_lines()])
+    elif input == "reglist":
+      reglist = Reglist.latest()
+      return reglist.hash() if reglist is not None else None
+    elif input == "youth_forms":
+      return hash_of(self._badgefile.youth_form_responses().youth_form(self))
+    raise ValueError(f"Unknown issue check input '{input}'")
+
+  # compare the results of run_issue_checks against this attendee's open issues, and return the changes needed to
+  # bring the Issues table up to date, in the form taken by IssueManager.apply.
+  def issue_changes(self, current_issues):
     existing_issues = self.open_issues()
-    new_issues = list(current_issues.keys() - existing_issues.keys())
-    resolved_issues = list(existing_issues.keys() - current_issues.keys())
-    continued_issues = list(existing_issues.keys() & current_issues.keys())
+    return {
+      "created": [[self, issue_type, current_issues[issue_type]] for issue_type in sorted(current_issues.keys() - existing_issues.keys())],
+      "updated": [[self, issue_type, current_issues[issue_type]] for issue_type in sorted(existing_issues.keys() & current_issues.keys())
+                  if existing_issues[issue_type] != json.dumps(current_issues[issue_type])],
+      "resolved": [[self, issue_type] for issue_type in sorted(existing_issues.keys() - current_issues.keys())],
+    }
 
-    for issue_type in new_issues:
-      IssueManager.shared().create(self, issue_type, current_issues[issue_type])
+  # record that the Issues table now matches the results of run_issue_checks, after applying issue_changes
+  def issue_changes_applied(self, current_issues):
+    self.set_open_issues({issue_type: json.dumps(issue_data) for issue_type, issue_data in current_issues.items()})
 
-    for issue_type in resolved_issues:
-      IssueManager.shared().resolve(self, issue_type)
+  def apply_issue_changes(self, current_issues, changes):
+    IssueManager.shared().apply(**changes)
+    self.issue_changes_applied(current_issues)
 
-    for issue_type in continued_issues:
-      if existing_issues[issue_type] != current_issues[issue_type]:
-        IssueManager.shared().update(self, issue_type, current_issues[issue_type])
+  # scan for new issues and insert them into the database if no similar issue is open for this user;
+  # mark previous issues as resolved if the issue has been corrected.
+  def scan_issues(self):
+    if self.is_manual():
+      return {}
 
+    current_issues = self.run_issue_checks()
+    self.apply_issue_changes(current_issues, self.issue_changes(current_issues))
     return current_issues
   
   def party_meal_plan(self):
@@ -733,14 +901,10 @@ class Attendee:
     return [activity for activity in self.primary().activities() if activity.is_housing() and activity.is_open()]
   
   def issue_categories(self):
-    return list(set(json.loads(issue)['category'] for issue in self.open_issues().values()))
+    return list(self.issues_by_category().keys())
   
   def issues_in_category(self, category):
-    issues = [json.loads(issue_raw) for issue_raw in self.open_issues().values()]
-    for issue in issues:
-      if 'category' not in issue:
-        log.error(f"ERROR: Issue for attendee {self.id()} {self.full_name()} missing 'category' field: {issue}")
-    return [issue for issue in issues if issue['category'] == category]
+    return list(self.issues_by_category().get(category, []))
     
   # returns a list of reglist rows referring to this user
   def reglist_rows(self):
@@ -836,8 +1000,7 @@ class Attendee:
       return False
     
     if not hasattr(self, '_youth_response'):
-      from datasources.sheets.youth_form_responses import YouthFormResponses
-      responses = YouthFormResponses(self._badgefile) # instantiation causes data pull, which should set youth form info for all attendees
+      responses = self._badgefile.youth_form_responses() # the first call pulls the sheet, which should set youth form info for all attendees
       self.set_youth_info(responses.youth_form(self)) # defensively set ours again anyway, in case we're not in badgefile.attendees() for some reason
     
     if self._youth_response is None:
@@ -1068,6 +1231,25 @@ class Attendee:
     hash_string = json.dumps(hashable)
     return hashlib.sha256(hash_string.encode('utf-8')).hexdigest()
   
+class AttendeeSnapshot(Attendee):
+  """A copy of an Attendee with its own info, for running issue checks on a worker thread without touching the live
+  attendee other threads share. It shares the original's caches, compares equal to (and hashes like) the original so
+  lookups such as Badgefile.parties() still find it, and refuses to write to the database."""
+
+  def __init__(self, attendee):
+    self.__dict__.update(attendee.__dict__)
+    self._info = copy.deepcopy(attendee._info)
+    self._original = attendee
+
+  def __eq__(self, other):
+    return other is self or other is self._original
+
+  def __hash__(self):
+    return hash(self._original)
+
+  def sync_to_db(self, existing_id=None):
+    raise RuntimeError(f"Attempted to write snapshot of attendee {self.id()} to the database")
+
 class ReglistCacher:
   _instance = None
   
@@ -1079,18 +1261,19 @@ class ReglistCacher:
   
   def __init__(self):
     self._reglist_rows_by_id = None
+    self._reglist_hash = None
 
   def reglist_rows_by_id(self, reglist, badgefile):
-    if self._reglist_rows_by_id is not None:
+    if self._reglist_rows_by_id is not None and self._reglist_hash == reglist.hash():
       return self._reglist_rows_by_id
     
     rrbid = {}
-    reglist_rows = [row.info() for row in reglist.rows()]
-    for row in reglist_rows:
-      attendee = badgefile.find_attendee_from_report_row(row)
+    for row in reglist.rows():
+      attendee = badgefile.match_reglist_row(row)
       if not attendee.id() in rrbid:
         rrbid[attendee.id()] = []
-      rrbid[attendee.id()].append(row)
+      rrbid[attendee.id()].append(row.info())
 
     self._reglist_rows_by_id = rrbid
+    self._reglist_hash = reglist.hash()
     return self._reglist_rows_by_id
\ No newline at end of file
@@ -0,0 +1,70 @@
+class AttendeeIndex:
+  """Maintains lookup tables over the Badgefile's attendee list, so finding an attendee by ID, hash ID, transrefnum, primary registrant name or similarity to a reglist row doesn't require a scan."""
+
+  # tables where each key identifies one attendee; lookups return the first attendee indexed under that key
+  UNIQUE_TABLES = ["badgefile_id", "hash_id"]
+
+  # tables where many attendees share a key (e.g. everyone in one registration transaction)
+  GROUP_TABLES = ["transrefnum", "primary_registrant_name", "similarity"]
+
+  def __init__(self, attendees=None):
+    self._tables = {table: {} for table in self.UNIQUE_TABLES + self.GROUP_TABLES}
+    self._keys = {} # id(attendee) -> list of (table, key) pairs the attendee is currently indexed under
+    for attendee in attendees or []:
+      self.add(attendee)
+
+  def keys_for_attendee(self, attendee):
+    info = attendee.info()
+    keys = [
+      ["badgefile_id", attendee.id()],
+      ["hash_id", info.get("hash_id")], # hash_id is calculated lazily, so it may not be present yet
+      ["transrefnum", info.get("transrefnum")],
+      ["primary_registrant_name", self.primary_registrant_name(attendee, info)],
+    ]
+    keys += [["similarity", key] for key in attendee.similarity_blocking_keys(info)]
+    return [[table, key] for table, key in keys if key is not None]
+
+  # the "given family" name of the attendee's primary registrant: their own name if they're a primary (including by
+  # override), and otherwise the name their reglist row gives for the primary
+  def primary_registrant_name(self, attendee, info):
+    try:
+      is_primary = attendee.is_primary()
+    except (KeyError, AttributeError):
+      is_primary = False # malformed info; Badgefile.correlate_primary_registrants logs these
+    if is_primary:
+      return f"{info.get('name_given')} {info.get('name_family')}"
+    return info.get("primary_registrant_name")
+
+  # add an attendee to the index, or refresh its entries if its ID, hash ID or info have changed since it was last indexed
+  def add(self, attendee):
+    self.remove(attendee)
+
+    keys = self.keys_for_attendee(attendee)
+    for table, key in keys:
+      self._tables[table].setdefault(key, []).append(attendee)
+    self._keys[id(attendee)] = keys
+
+  def remove(self, attendee):
+    for table, key in self._keys.pop(id(attendee), []):
+      entries = self._tables[table].get(key, [])
+      if attendee in entries:
+        entries.remove(attendee)
+      if len(entries) == 0:
+        self._tables[table].pop(key, None)
+
+  # return the attendee indexed under the given key in one of the UNIQUE_TABLES, or None
+  def lookup(self, table, key):
+    entries = self._tables[table].get(key)
+    return entries[0] if entries else None
+
+  # return a list of all attendees indexed under the given key in one of the GROUP_TABLES
+  def lookup_all(self, table, key):
+    return list(self._tables[table].get(key, []))
+
+  # return a list of attendees indexed under any of the given keys in one of the GROUP_TABLES, without duplicates
+  def lookup_any(self, table, keys):
+    found = {}
+    for key in keys:
+      for attendee in self._tables[table].get(key, []):
+        found.setdefault(id(attendee), attendee)
+    return list(found.values())
@@ -1,12 +1,16 @@
 from integrations.database import Database
-from .attendee import Attendee
+from .attendee import Attendee, ReglistCacher
+from .attendee_index import AttendeeIndex
 from .id_manager import IdManager
+from .issue_manager import IssueManager
+from .local_attendee_overrides import LocalAttendeeOverrides
 from datasources.clubexpress.reglist import Reglist
 from datasources.clubexpress.activity_list import ActivityList
 from datasources.clubexpress.activity import Activity
 from datasources.clubexpress.housing_activity_list import HousingActivityList
 from datasources.sheets.attendee_status import AttendeeStatusSource
 from datasources.sheets.masters_sheet import MastersSheet
+from datasources.sheets.youth_form_responses import YouthFormResponses
 from datasources.clubexpress.housing_reglist import HousingReglist
 from datasources.clubexpress.payments_report import PaymentsReport
 from datasources.tdlist import TDList
@@ -31,6 +35,8 @@ from util.secrets import secret
 from log.logger import log
 from model.registrar_sheet import RegistrarSheet
 
+from concurrent.futures import ThreadPoolExecutor
+import heapq
 import json
 import os
 import time
@@ -39,10 +45,17 @@ import yaml
 class Badgefile:
   """Encapsulates the master view of the Badgefile, which lists all Attendees at the Go Congress."""
 
+  REGLIST_ROWS_PER_BATCH = 100 # reglist rows merged into attendees per transaction in update_attendees
+
   def __init__(self):
     self._attendees = None
+    self._index = None
     self._parties = None
     self._override_map = None
+    self._youth_form_responses = None
+    self._full_rescan = False
+    self._reglist_matches = {}
+    self._reglist_matches_hash = None
     self.is_online = True
 
   def path(self):
@@ -69,60 +82,218 @@ class Badgefile:
 
   def update_attendees(self):
     log.debug("Updating badgefile")
+    # read every report and sheet before writing anything, so we don't hold the database write lock (and block web.py)
+    # while waiting on disk or Google Sheets
+    Reglist.latest()
+    activity_list = ActivityList.latest()
+    housing_activity_list = HousingActivityList.latest()
+    td_list = TDList.latest()
+    as_source = AttendeeStatusSource(self)
+    tournament_data = as_source.read_tournament_data()
+    overrides = as_source.read_manual_badge_data()
+    youth_form_data = YouthFormResponses.read_sheet_data() if self.is_online else None
+
+    # match every reglist row to its attendee before opening any transaction. matching can issue guest IDs, which
+    # commit on their own; inside a batch, the first of those would hold the write lock through all the matching.
+    Attendee.reset_sync_stats()
+    self.reset_reglist_matches()
     reglist_rows = self.active_reglist_rows()
-    for row in reglist_rows:
-      self.update_or_create_attendee_from_reglist_row(row)
-    self.prune_silent_cancellations(reglist_rows)
+
+    # each phase of writes below is its own transaction (or several), so the thousands of attendee/issue writes in a
+    # phase don't each commit separately, and a failure in a later phase doesn't roll back the ones before it. rows are
+    # merged a chunk at a time, so scans in web.py (which wait for the write lock) never wait long.
+    for start in range(0, len(reglist_rows), self.REGLIST_ROWS_PER_BATCH):
+      with Database.shared().batch():
+        for row in reglist_rows[start:start+self.REGLIST_ROWS_PER_BATCH]:
+          self.update_or_create_attendee_from_reglist_row(row)
+
+    with Database.shared().batch():
+      self.prune_silent_cancellations(reglist_rows)
     
-    for attendee in self.attendees():
-      attendee.hash_id() # force calculation of hash_id. TODO: this is hideous, but it fixes a bug I need fixed ASAP
-      attendee.invalidate_activities()
+      for attendee in self.attendees():
+        attendee.hash_id() # force calculation of hash_id. TODO: this is hideous, but it fixes a bug I need fixed ASAP
+        attendee.invalidate_activities()
     
     # by doing the ActivityList/HousingActivityList.latest().rows(), we ensure all the current rows are in the DB
     # problem: if someone cancels an event manually in CE, the row is deleted from the report, and not marked as cancelled
     # so we have to list all the activity_registrant_ids that are in the sheets, then hand them to a method that deletes anything in the Activities tables not in that list
-    all_act_ids  = [act.info()['activity_registrant_id'] for act in ActivityList.latest().rows(self) if act is not None] # merely asking for the rows causes them to be saved to the DB
-    all_act_ids += [act.info()['activity_registrant_id'] for act in HousingActivityList.latest().rows(self) if act is not None] # also force housing rows to DB
-    Activity.prune_to_activity_registrant_ids(all_act_ids)
+    with Database.shared().batch():
+      all_act_ids  = [act.info()['activity_registrant_id'] for act in activity_list.rows(self) if act is not None] # merely asking for the rows causes them to be saved to the DB
+      all_act_ids += [act.info()['activity_registrant_id'] for act in housing_activity_list.rows(self) if act is not None] # also force housing rows to DB
+      Activity.prune_to_activity_registrant_ids(all_act_ids)
     
-    TDList.latest().apply(self) # Now go apply ratings/expiration dates/chapters from the TD list
+    td_list.apply(self) # Now go apply ratings/expiration dates/chapters from the TD list
     
     # now apply manual overrides
-    as_source = AttendeeStatusSource(self)
-    as_source.read_tournament_overrides()
-    overrides = as_source.read_manual_badge_data()
+    with Database.shared().batch():
+      as_source.read_tournament_overrides(tournament_data)
     
-    for override in overrides:
-      if override.get('badgefile_id'):
-        attendee = self.lookup_attendee(override['badgefile_id'])
-        if attendee is None:
-          log.notice(f"Unable to find attendee for overridden badge with id {override['badgefile_id']}, description '{override['description']}'")
-          continue
-        attendee.set_manual_override(override)
-      elif (override.get('name_given') or override.get('name_family')) and override.get('badge_type'):
-        log.info(f"issuing manual badge: {override}")
-        self.issue_manual_attendee(override)
-
-    log.debug("Ensuring consistency...")
+      for override in overrides:
+        if override.get('badgefile_id'):
+          attendee = self.lookup_attendee(override['badgefile_id'])
+          if attendee is None:
+            log.notice(f"Unable to find attendee for overridden badge with id {override['badgefile_id']}, description '{override['description']}'")
+            continue
+          attendee.set_manual_override(override)
+        elif (override.get('name_given') or override.get('name_family')) and override.get('badge_type'):
+          log.info(f"issuing manual badge: {override}")
+          self.issue_manual_attendee(override)
+
+    # record who has a youth form on file, once all the attendees exist; issue checks use these same responses
+    with Database.shared().batch():
+      self._youth_form_responses = YouthFormResponses(self, data=youth_form_data)
+
+    with Database.shared().batch():
+      log.debug("Ensuring consistency...")
+      start_time = time.time()
+      self.ensure_consistency()
+      elapsed_ms = (time.time() - start_time) * 1000
+      log.debug(f"Consistency check completed in {elapsed_ms:.2f} ms")
+
+      log.debug("Populating derived fields...")
+      start_time = time.time()
+      for attendee in self.attendees():
+        attendee.populate_derived_fields()
+      elapsed_ms = (time.time() - start_time) * 1000
+      log.debug(f"Populating derived fields completed in {elapsed_ms:.2f} ms")
+
+    stats = Attendee.sync_stats()
+    log.debug(f"Attendee writes during update: {stats['rows_written']} rows written ({stats['columns_written']} columns), {stats['syncs_skipped']} unchanged syncs skipped")
+
+    # scan outside the update transactions, so that parallel scan workers (which read through their own connections)
+    # see everything written above
+    self.scan_issues()
+
+  # the number of threads used to run issue checks in scan_issues; 1 runs them serially on the calling thread
+  def issue_scan_workers(self):
+    return max(1, int(secret("issue_scan_workers", 1) or 1))
+
+  # make the next scan_issues re-run every check for every attendee, rather than skipping checks whose inputs are
+  # unchanged since the last scan
+  def request_full_rescan(self):
+    self._full_rescan = True
+
+  # run the issue checks for every attendee, then apply all resulting issue creations/updates/resolutions in one
+  # transaction. checks whose inputs haven't changed since the last scan are skipped, unless full_rescan is set
+  # (or request_full_rescan was called).
+  def scan_issues(self, workers=None, full_rescan=False):
+    full_rescan = full_rescan or self._full_rescan
+    workers = workers or self.issue_scan_workers()
+    if workers > 1 and Database.shared().in_batch():
+      # workers can't see writes from an open transaction on this thread, so they'd be checking stale data
+      log.debug("Issue scan requested inside a database batch; scanning serially")
+      workers = 1
+
+    attendees = [attendee for attendee in self.attendees() if not attendee.is_manual()]
+    timings = {}
+
+    # each attendee's fingerprints dict starts as the stored fingerprints from the last scan (or empty, to run every
+    # check), and is updated by run_issue_checks to the current ones
+    stored_fingerprints = IssueManager.shared().check_fingerprints_by_badgefile_id()
+    fingerprints = {}
+    for attendee in attendees:
+      fingerprints[attendee] = {} if full_rescan else dict(stored_fingerprints.get(attendee.id(), {}))
+
+    log.debug(f"Scanning attendees for issues ({workers} workers{', full rescan' if full_rescan else ''})...")
     start_time = time.time()
-    self.ensure_consistency()
+    if workers > 1:
+      results = self.run_issue_checks_parallel(attendees, workers, timings, fingerprints)
+    else:
+      results = []
+      for attendee in attendees:
+        log.trace(f"Checking {attendee.full_name()}")
+        results.append([attendee, attendee.run_issue_checks(timings, fingerprints[attendee])])
     elapsed_ms = (time.time() - start_time) * 1000
-    log.debug(f"Consistency check completed in {elapsed_ms:.2f} ms")
+    num_runs = sum(runs for runs, total_ms in timings.values())
+    log.debug(f"Scanning attendees for issues completed in {elapsed_ms:.2f} ms ({num_runs} checks run)")
+
+    slowest = sorted(timings.items(), key=lambda item: item[1][1], reverse=True)[:5]
+    for issue_type, (runs, total_ms) in slowest:
+      log.debug(f"Issue check {issue_type}: {total_ms:.2f} ms total over {runs} attendees ({total_ms / max(runs, 1):.3f} ms avg)")
 
-    log.debug("Populating derived fields...")
     start_time = time.time()
-    for attendee in self.attendees():
-      attendee.populate_derived_fields()
+    all_changes = {"created": [], "updated": [], "resolved": []}
+    changed_fingerprints = []
+    for attendee, current_issues in results:
+      for kind, changes in attendee.issue_changes(current_issues).items():
+        all_changes[kind] += changes
+      stored = stored_fingerprints.get(attendee.id(), {})
+      changed_fingerprints += [[attendee, issue_type, fingerprint] for issue_type, fingerprint in fingerprints[attendee].items()
+                               if stored.get(issue_type) != fingerprint]
+    IssueManager.shared().apply(**all_changes, fingerprints=changed_fingerprints)
+    for attendee, current_issues in results:
+      attendee.issue_changes_applied(current_issues)
     elapsed_ms = (time.time() - start_time) * 1000
-    log.debug(f"Populating derived fields completed in {elapsed_ms:.2f} ms")
+    counts = ", ".join(f"{len(changes)} {kind}" for kind, changes in all_changes.items())
+    log.debug(f"Applied issue changes ({counts}) in {elapsed_ms:.2f} ms")
+    self._full_rescan = False
+
+  def run_issue_checks_parallel(self, attendees, workers, timings, fingerprints):
+    self.prepare_issue_scan(attendees)
+
+    # hand each worker a contiguous chunk of attendees, with its own timings dict to merge afterwards
+    chunk_size = max(1, -(-len(attendees) // (workers * 4)))
+    chunks = [attendees[i:i+chunk_size] for i in range(0, len(attendees), chunk_size)]
+
+    # workers run the checks against snapshots, so nothing they do can write to an attendee (or the database) that
+    # other threads share; results and fingerprints are applied to the live attendees back on this thread
+    snapshots = {attendee: attendee.snapshot() for attendee in attendees}
+
+    # an attendee whose scan fails outright (a failing check is already handled by run_issue_checks) is logged and left
+    # out of the results, so their issues and fingerprints are left as they were
+    def run_chunk(chunk):
+      chunk_timings = {}
+      chunk_results = []
+      for attendee in chunk:
+        try:
+          chunk_results.append([attendee, snapshots[attendee].run_issue_checks(chunk_timings, fingerprints[attendee])])
+        except Exception as exc:
+          log.error(f"Encountered an exception scanning {attendee.full_name()} {attendee.id()} for issues", exception=exc)
+      return chunk_results, chunk_timings
+
+    results = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="issue-scan") as executor:
+      for chunk_results, chunk_timings in executor.map(run_chunk, chunks):
+        results += chunk_results
+        for issue_type, (runs, total_ms) in chunk_timings.items():
+          timing = timings.setdefault(issue_type, [0, 0.0])
+          timing[0] += runs
+          timing[1] += total_ms
+    return results
+
+  # the issue checks lean on lazily-built caches (party lists, activities, payment lines, reglist matches, youth
+  # forms). build them all up front, so the worker threads in run_issue_checks_parallel only ever read shared state.
+  def prepare_issue_scan(self, attendees):
+    from datasources.clubexpress.registration_fees_charges_congress import RegistrationFeesChargesCongress
+    from datasources.clubexpress.registration_fees_charges_housing import RegistrationFeesChargesHousing
+
+    self.attendee_index()
+    self.parties()
+    self.override_map()
+
+    reglist = Reglist.latest()
+    if reglist is not None:
+      ReglistCacher.shared().reglist_rows_by_id(reglist, self)
+
+    for report_class in [RegistrationFeesChargesCongress, RegistrationFeesChargesHousing]:
+      report = report_class.latest()
+      if report is not None:
+        report.by_transrefnum()
+
+    LocalAttendeeOverrides.shared()
+    self.youth_form_responses()
+
+    for attendee in attendees:
+      attendee.activities()
+      attendee.parsed_open_issues()
+
+  # the youth form sheet, as read by the last update_attendees (or on first use, if there hasn't been one). reading it
+  # records whether each attendee has a youth form on file (see Attendee.set_youth_info).
+  def youth_form_responses(self):
+    if self._youth_form_responses is None:
+      self._youth_form_responses = YouthFormResponses(self)
+    return self._youth_form_responses
 
-    log.debug("Scanning attendees for issues...")
-    start_time = time.time()
-    for attendee in self.attendees():
-      log.trace(f"Checking {attendee.full_name()}")
-      attendee.scan_issues()
-    log.debug(f"Scanning attendees for issues completed in {elapsed_ms:.2f} ms")
-  
   def update_raw_reports(self):
     IssueSheet(self).generate("artifacts/issue_sheet.csv")
     DonorReport(self).generate("artifacts/donor_report.csv")
@@ -208,6 +379,7 @@ class Badgefile:
     att.set_manual_override(info)
     if self._attendees:
       self._attendees.append(att)
+      self._index.add(att)
     return att
     
   def generate_json(self):
@@ -243,18 +415,15 @@ class Badgefile:
     except ValueError:
       return None
     
-    for attendee in self.attendees(include_cancelled=True):
-      if attendee.id() == badgefile_id:
-        return attendee
+    index = self.attendee_index()
+    attendee = index.lookup("badgefile_id", badgefile_id)
+    if attendee is not None:
+      return attendee
 
     override_map = self.override_map()   
     if badgefile_id in override_map:
       badgefile_id = override_map[badgefile_id]
-    for attendee in self.attendees(include_cancelled=True):
-      if attendee.id() == badgefile_id:
-        return attendee
-    
-    return None
+    return index.lookup("badgefile_id", badgefile_id)
 
   def override_map(self, force=False):
     if self._override_map is None or force:
@@ -266,24 +435,42 @@ class Badgefile:
     return self._override_map
 
   def lookup_attendee_by_hash_id(self, hash_id):
-    for attendee in self.attendees(include_cancelled=True):
-      if attendee.hash_id() == hash_id:
-        return attendee
+    index = self.attendee_index()
+    attendee = index.lookup("hash_id", hash_id)
+    if attendee is not None:
+      return attendee
     
-    return None
+    # hash_ids are calculated lazily, so some attendees may not have been indexed by hash_id yet.
+    # calculate everyone's hash_id and try again.
+    for attendee in self.attendees(include_cancelled=True):
+      if attendee.info().get("hash_id") is None:
+        attendee.hash_id()
+      index.add(attendee)
+    return index.lookup("hash_id", hash_id)
   
   # return list of all attendees
   def attendees(self, force_refresh=False, include_cancelled=False):
     if self._attendees is None or force_refresh:
       log.debug("badgefile: Loading attendees list")
       Attendee(self).ensure_attendee_table() # shouldn't be instance method of Attendee
-      rows = Database.shared().query("SELECT * FROM Attendees")
+      rows = Database.shared().iter_query("SELECT * FROM Attendees") # stream rows straight into Attendees rather than holding both in memory
       self._attendees = [Attendee(self).load_db_row(row) for row in rows]
+      self._index = AttendeeIndex(self._attendees)
+      self.reset_reglist_matches() # cached matches refer to the old Attendee objects
       self.ensure_consistency()
+      open_issues = IssueManager.shared().open_issues_by_badgefile_id() # one query, rather than one per attendee
+      for attendee in self._attendees:
+        attendee.set_open_issues(open_issues.get(attendee.id(), {}))
       log.debug(f"badgefile: Loaded {len(self._attendees)} attendees")
     if not include_cancelled:
       return [att for att in self._attendees if not att.is_cancelled()]
     return self._attendees
+
+  # return the AttendeeIndex covering all attendees, including cancelled ones
+  def attendee_index(self):
+    if self._index is None:
+      self.attendees()
+    return self._index
   
   def parties(self):
     if self._parties is None:
@@ -303,18 +490,24 @@ class Badgefile:
     badgefile_id = IdManager.shared().lookup_reg_info(row)
 
     if badgefile_id != None:
+      # look up the canonical ID's aliases now, rather than indexing them, so changes to BadgefileIdMaps are seen
       canonical_id = IdManager.shared().canonical_id(badgefile_id)
-      for attendee in self.attendees(include_cancelled=True):
-        if IdManager.shared().canonical_id(attendee.id()) == canonical_id:
+      index = self.attendee_index()
+      for candidate_id in IdManager.shared().ids_with_canonical_id(canonical_id):
+        attendee = index.lookup("badgefile_id", candidate_id)
+        if attendee is not None:
           return attendee
       
       log.debug(f"Attendee has badgefile_id {badgefile_id}, but no attendee matches.", data=row)
       return None
 
-    scored = [ [attendee, attendee.similarity_score(row)] for attendee in self.attendees(include_cancelled=True) ]
-    scored.sort(key=lambda x: x[1], reverse=True)
+    # only attendees sharing a blocking key with the row can score above 0, so only score those.
+    # everyone else would have scored 0, which can't affect best_score or delta below.
+    blocking_keys = Attendee.similarity_blocking_keys(row, for_row=True)
+    candidates = self.attendee_index().lookup_any("similarity", blocking_keys)
+    scored = heapq.nlargest(2, ([attendee, attendee.similarity_score(row)] for attendee in candidates), key=lambda x: x[1])
 
-    # no attendees yet
+    # no attendees yet, or none with anything in common with this row
     if len(scored) == 0:
       log.debug(f"No existing member matches '{row['name_given']} {row['name_family']}', born {row['date_of_birth']}")
       return None
@@ -331,12 +524,33 @@ class Badgefile:
     log.debug(f"Existing member matches '{row['name_given']} {row['name_family']}', born {row['date_of_birth']}, mobile {row['phone_mobile']}: ID {scored[0][0].id()}, score {scored[0][1]}")
     return scored[0][0]
   
+  def reset_reglist_matches(self):
+    self._reglist_matches = {}
+    self._reglist_matches_hash = None
+
+  # returns the same result as find_attendee_from_report_row for a ReglistRow, but remembers it by reglist hash and row number,
+  # so active_reglist_rows, update_or_create_attendee_from_reglist_row and ReglistCacher only match each row once per update_attendees run.
+  # None means the row belongs to an attendee we haven't created yet.
+  def match_reglist_row(self, row):
+    reglist_hash = row.reglist.hash()
+    if self._reglist_matches_hash != reglist_hash:
+      # a different reglist has been loaded (e.g. via Reglist.latest(force=True)), so nothing we've cached applies anymore
+      self._reglist_matches = {}
+      self._reglist_matches_hash = reglist_hash
+
+    if row.row_num is None:
+      return self.find_attendee_from_report_row(row.info())
+
+    if row.row_num not in self._reglist_matches:
+      self._reglist_matches[row.row_num] = self.find_attendee_from_report_row(row.info())
+    return self._reglist_matches[row.row_num]
+  
   def active_reglist_rows(self):
     by_attendee = {}
     rows = Reglist.latest().rows()
-    for i, row in enumerate(rows):
-      row_num = i + 2 # convert to excel-style row number, understanding that it is one-based and has a header row
-      attendee = self.find_attendee_from_report_row(row.info())
+    for row in rows:
+      row_num = row.row_num
+      attendee = self.match_reglist_row(row)
       if attendee is None:
         attendee = Attendee(self)
         attendee.load_reglist_row(row, sync=False)
@@ -371,14 +585,21 @@ class Badgefile:
   # returns an Attendee corresponding to the user in the reglist. uses an existing Attendee
   # if one exists; otherwise, creates one.
   def update_or_create_attendee_from_reglist_row(self, row):
-    attendee = self.find_attendee_from_report_row(row.info())
+    attendee = self.match_reglist_row(row)
     if attendee != None:
       attendee.load_reglist_row(row, True)
+      self._index.add(attendee) # reglist row may have changed badgefile_id, transrefnum, etc.
       return attendee
     
     # no good matches; create a new attendee
     attendee = Attendee(self).load_reglist_row(row)
     self._attendees.append(attendee)
+    self._index.add(attendee)
+
+    # other rows we couldn't match before may belong to this new attendee, so forget those misses
+    self._reglist_matches = {row_num: match for row_num, match in self._reglist_matches.items() if match is not None}
+    if row.row_num is not None:
+      self._reglist_matches[row.row_num] = attendee
     return attendee
   
   def ensure_consistency(self):
@@ -393,6 +614,18 @@ class Badgefile:
       except Exception as exc:
         log.warn(f"Encountered an exception finding primary registrant for {attendee.full_name()}", exception=exc)
   
+  # return the active primary registrants indexed under a key in one of the attendee index's GROUP_TABLES. an attendee
+  # whose info is too malformed to tell whether they're a primary is logged and skipped, rather than failing the lookup.
+  def primary_registrants_indexed_under(self, table, key):
+    primaries = []
+    for att in self.attendee_index().lookup_all(table, key):
+      try:
+        if not att.is_cancelled() and att.is_primary():
+          primaries.append(att)
+      except Exception as exc:
+        log.warn(f"Encountered an exception indexing {att.full_name()} as a primary registrant", exception=exc)
+    return primaries
+  
   def locate_primary_for_attendee(self, attendee):
     # easiest case: the attendee is marked as the primary for a registration. no searching needed!
     if attendee.is_primary():
@@ -400,19 +633,15 @@ class Badgefile:
     
     # most people's primaries have the same transrefnum, so see if we can find a primary registrant who matches transrefnum
     transrefnum = attendee.info()["transrefnum"]
-    for att in self.attendees():
-      if att.info()["transrefnum"] != transrefnum:
-        continue
-      if not att.is_primary():
-        continue
-
-      # found primary registrant for this transaction
-      return att
+    primaries = self.primary_registrants_indexed_under("transrefnum", transrefnum)
+    if len(primaries) > 0:
+      # found primary registrant for this transaction; the first one wins
+      return primaries[0]
     
     # sometimes people are non-primary registrants on a different transaction, so now we have to try to match on primary_registrant_name
-    # primary_registrant_name is based on "%s %s" % (first_name, last_name) so look for that
+    # primary_registrant_name is based on "%s %s" % (first_name, last_name), which is how primaries are indexed
     prn = attendee.info()["primary_registrant_name"]
-    candidates = [att for att in self.attendees() if f"{att.info()['name_given']} {att.info()['name_family']}" == prn and att.is_primary()]
+    candidates = self.primary_registrants_indexed_under("primary_registrant_name", prn)
     if len(candidates) == 1:
       # we found exactly one match, which is the best outcome.
       return candidates[0]
@@ -421,6 +650,7 @@ class Badgefile:
       # CE does actually produce this case; see 2025's May 2nd transaction 7717 in the registrant data for an example.
       log.notice(f"Unable to locate primary registrant for attendee {attendee.info()['name_given']} {attendee.info()['name_family']} ({attendee.info()['badgefile_id']}); searched for name '{prn}' and/or transrefnum '{transrefnum}'. Treating as own primary registrant.")
       attendee.override_primary()
+      self._index.add(attendee) # attendee is now a primary, and later attendees may match against them
       return attendee
     else:
       # multiple matches; very bad!! needs manual solution.
@@ -1,7 +1,10 @@
 from integrations.database import Database
 from datetime import datetime
+import threading
+import time
 from log.logger import log
 from model.notification_manager import NotificationManager
+from model.scan_ingest import ScanIngest
 
 class AttendeeNotEligible(Exception):
     """Exception raised when an attendee tries to scan in but is not eligible."""
@@ -9,9 +12,19 @@ class AttendeeNotEligible(Exception):
 
 class Event:
   _instances = {}
+  _ensured = set() # names of events whose tables ensure_db has already created in this process
+  _totals = {} # event name -> running totals as last read or written by this process; see totals()
+  _totals_lock = threading.RLock() # held across each write that changes the totals, and the cache update that follows
+  _versions = {} # event name -> number of times the event's totals have been updated in this process
+  _version_lock = threading.Lock()
+  _changed = {} # event name -> threading.Condition on _version_lock, notified whenever the event's totals are updated
+  _waiters = {} # event name -> number of threads currently blocked in wait_for_change
+  _poller = None # thread re-reading the totals of events with waiters; see poll_for_external_changes
+  EXTERNAL_POLL_INTERVAL = 1.0 # seconds between re-reads of the totals of events that have waiters
 
   @classmethod
   def exists(cls, name):
+    # always ask the database, rather than trusting _ensured, since another process may have created the tables
     db = Database.shared()
     status_table = f"event_{name}_status"
     result = db.query(f"SELECT name FROM sqlite_master WHERE type='table' AND name=?", [status_table])
@@ -24,73 +37,132 @@ class Event:
   def nuke(self):
     db = Database.shared()
     log.info(f"Nuking event {self.name}")
-    db.execute(f"DELETE FROM event_{self.name}_status")
-    db.execute(f"DELETE FROM event_{self.name}_scans")
-    db.execute(f"DELETE FROM event_{self.name}_enrollments")
+    with Event._totals_lock:
+      ScanIngest.shared().reset(self.name)
+      db.execute(f"DELETE FROM event_{self.name}_status")
+      db.execute(f"DELETE FROM event_{self.name}_scans")
+      db.execute(f"DELETE FROM event_{self.name}_enrollments")
+      self.rebuild_totals()
   
   def mark_attendee_eligible(self, attendee, is_eligible=True):
     # insert a row into the table for the attendee (if one does not exist for badgefile_id=attendee.id()) with scan_count=0
     # no-op if a row already exists for that attendee with the same eligibility status
     db = Database.shared()
-    
-    # Check if attendee already exists in status table
     status_table = f"event_{self.name}_status"
-    result = db.query(f"SELECT * FROM {status_table} WHERE badgefile_id = ?", [attendee.id()])
-    
-    # Check if we need to make any changes
-    if result and result[0]['is_eligible'] == is_eligible:
-      # Status already matches, no need to update anything
-      return
-    
-    # Record this eligibility change in the enrollments table first
     enrollments_table = f"event_{self.name}_enrollments"
-    db.execute(f"INSERT INTO {enrollments_table} (badgefile_id, timestamp_changed, is_eligible) VALUES (?, ?, ?)",
-              [attendee.id(), datetime.now().timestamp(), is_eligible])
-    
-    # Then update or insert into status table
-    if not result:
-      # Insert new row with scan_count=0 and specified is_eligible value
-      db.execute(f"INSERT INTO {status_table} (badgefile_id, scan_count, is_eligible) VALUES (?, 0, ?)", 
-                [attendee.id(), is_eligible])
-    else:
-      # Update existing row with new eligibility status
-      db.execute(f"UPDATE {status_table} SET is_eligible = ? WHERE badgefile_id = ?",
-                [is_eligible, attendee.id()])
-    
-    NotificationManager.shared().notify("event", {"event": self, "attendee": attendee, "action": "enrollment", "data": {"is_eligible": is_eligible}})
-  
+
+    with Event._totals_lock:
+      # in ingest mode, write out any queued scans so the status and totals we're about to change are current. holding
+      # _totals_lock keeps more scans from being queued until we're done.
+      ingest = ScanIngest.shared()
+      if ingest.enabled():
+        ingest.flush()
+
+      with db.batch():
+        # Check if attendee already exists in status table
+        result = db.query(f"SELECT * FROM {status_table} WHERE badgefile_id = ?", [attendee.id()])
+
+        # Check if we need to make any changes
+        if result and result[0]['is_eligible'] == is_eligible:
+          # Status already matches, no need to update anything
+          return
+
+        # Record this eligibility change in the enrollments table first
+        db.execute(f"INSERT INTO {enrollments_table} (badgefile_id, timestamp_changed, is_eligible) VALUES (?, ?, ?)",
+                  [attendee.id(), datetime.now().timestamp(), is_eligible])
+
+        # Then update or insert into status table
+        if not result:
+          # Insert new row with scan_count=0 and specified is_eligible value
+          db.execute(f"INSERT INTO {status_table} (badgefile_id, scan_count, is_eligible) VALUES (?, 0, ?)",
+                    [attendee.id(), is_eligible])
+        else:
+          # Update existing row with new eligibility status
+          db.execute(f"UPDATE {status_table} SET is_eligible = ? WHERE badgefile_id = ?",
+                    [is_eligible, attendee.id()])
+
+        # anyone who has been scanned counts as scannable regardless of eligibility
+        scan_count = result[0]['scan_count'] if result else 0
+        was_scannable = bool(result) and (bool(result[0]['is_eligible']) or scan_count > 0)
+        is_scannable = bool(is_eligible) or scan_count > 0
+        totals = self.adjust_totals(scannable=int(is_scannable) - int(was_scannable))
+      self.cache_totals(totals) # only once committed
+      if ingest.enabled():
+        ingest.set_status(self, attendee.id(), scan_count, is_eligible, totals)
+
+    NotificationManager.shared().notify("event", {"event": self, "attendee": attendee, "action": "enrollment", "data": {"is_eligible": is_eligible, **totals}})
+
   def scan_in_attendee(self, attendee, is_reset=False):
+    return self.scan(attendee, is_reset=is_reset)["num_times_attendee_scanned"]
+
+  # record a scan (or a reset) of an attendee's badge in a single transaction, returning a dict with the attendee's
+  # new scan count along with the event totals from totals(). raises AttendeeNotEligible, without recording anything,
+  # if the attendee isn't eligible for this event. in ingest mode (see ScanIngest), the scan is acknowledged from
+  # memory and written shortly afterwards.
+  def scan(self, attendee, is_reset=False):
     db = Database.shared()
     status_table = f"event_{self.name}_status"
     scans_table = f"event_{self.name}_scans"
-    
-    # Check if attendee exists in status table
-    result = db.query(f"SELECT * FROM {status_table} WHERE badgefile_id = ?", [attendee.id()])
-    if not self.is_attendee_eligible(attendee):
-      raise AttendeeNotEligible(f"Attendee with ID {attendee.id()} is not eligible for event {self.name}")
-    
-    # Record scan
-    current_time = datetime.now().timestamp()
-    db.execute(f"INSERT INTO {scans_table} (badgefile_id, timestamp_scanned, is_reset) VALUES (?, ?, ?)",
-              [attendee.id(), current_time, is_reset])
-    
-    if is_reset:
-      db.execute(f"UPDATE {status_table} SET scan_count = 0 WHERE badgefile_id = ?", [attendee.id()])
-    else:
-      # Increment scan_count
-      db.execute(f"UPDATE {status_table} SET scan_count = scan_count + 1 WHERE badgefile_id = ?",
-                [attendee.id()])
-    
-    # Get and return the new scan count
-    updated_result = db.query(f"SELECT scan_count FROM {status_table} WHERE badgefile_id = ?", [attendee.id()])
-    scan_count = updated_result[0]['scan_count']
+    ingest = ScanIngest.shared()
+
+    with Event._totals_lock:
+      current_time = datetime.now().timestamp() # taken under the lock, so scans are timestamped in the order recorded
+      if ingest.enabled():
+        status = ingest.state(self)["status"].get(attendee.id())
+        if not status or not status['is_eligible']:
+          raise AttendeeNotEligible(f"Attendee with ID {attendee.id()} is not eligible for event {self.name}")
+
+        previous_count = status['scan_count']
+        scan_count = 0 if is_reset else previous_count + 1
+        totals = self.totals()
+        totals['total_attendees_scanned'] += int(scan_count > 0) - int(previous_count > 0)
+        ingest.queue_scan(self, attendee.id(), current_time, is_reset, scan_count, totals)
+        self.cache_totals(totals)
+      else:
+        while True:
+          # check eligibility before writing anything, so an ineligible scan doesn't need rolling back
+          status = db.query(f"SELECT scan_count, is_eligible FROM {status_table} WHERE badgefile_id = ?", [attendee.id()])
+          if not status or not status[0]['is_eligible']:
+            raise AttendeeNotEligible(f"Attendee with ID {attendee.id()} is not eligible for event {self.name}")
+
+          previous_count = status[0]['scan_count']
+          scan_count = 0 if is_reset else previous_count + 1
+          with db.batch():
+            # this update is the transaction's first write, so from here until commit we hold the database's write lock.
+            # it only matches the status row as we read it; if another process changed the row in the meantime, nothing
+            # is written, and we read it again.
+            updated = db.execute(f"UPDATE {status_table} SET scan_count = ? WHERE badgefile_id = ? AND scan_count = ? AND is_eligible",
+                                 [scan_count, attendee.id(), previous_count])
+            if updated == 0:
+              continue
+
+            db.execute(f"INSERT INTO {scans_table} (badgefile_id, timestamp_scanned, is_reset) VALUES (?, ?, ?)",
+                      [attendee.id(), current_time, is_reset])
+
+            # the attendee is eligible, so they were already counted as scannable; only the scanned total can change
+            totals = self.adjust_totals(scanned=int(scan_count > 0) - int(previous_count > 0))
+          break
+        self.cache_totals(totals) # only once committed
+
     self.scan_time = current_time
+    scan_result = {
+      "is_reset": is_reset,
+      "num_times_attendee_scanned": scan_count,
+      "total_attendees_scanned": totals['total_attendees_scanned'],
+      "total_scannable": totals['total_scannable'],
+    }
 
     log.debug(f"Scanned attendee {attendee.full_name()} into {self.name}, is_reset={is_reset}; new count {scan_count}")
-    NotificationManager.shared().notify("event", {"event": self, "attendee": attendee, "action": "scan", "data": {"is_reset": is_reset, "num_times_attendee_scanned": scan_count}})
-    return scan_count
+    NotificationManager.shared().notify("event", {"event": self, "attendee": attendee, "action": "scan", "data": scan_result})
+    return scan_result
 
   def is_attendee_eligible(self, attendee):
+    ingest = ScanIngest.shared()
+    if ingest.enabled():
+      with Event._totals_lock:
+        status = ingest.state(self)["status"].get(attendee.id())
+      return bool(status and status['is_eligible'])
+
     db = Database.shared()
     status_table = f"event_{self.name}_status"
     
@@ -100,6 +172,12 @@ class Event:
     return False
 
   def num_times_attendee_scanned(self, attendee):
+    ingest = ScanIngest.shared()
+    if ingest.enabled():
+      with Event._totals_lock:
+        status = ingest.state(self)["status"].get(attendee.id())
+      return status['scan_count'] if status else 0
+
     db = Database.shared()
     status_table = f"event_{self.name}_status"
     
@@ -109,6 +187,11 @@ class Event:
     return 0
   
   def scan_counts(self):
+    ingest = ScanIngest.shared()
+    if ingest.enabled():
+      with Event._totals_lock:
+        return {badgefile_id: dict(status) for badgefile_id, status in ingest.state(self)["status"].items()}
+
     db = Database.shared()
     status_table = f"event_{self.name}_status"
     
@@ -123,29 +206,136 @@ class Event:
     
     return status_dict
 
-  def num_scanned_attendees(self, include_ineligible=True):
+  # return the event's headline numbers: total_attendees_scanned (as num_scanned_attendees()) and total_scannable
+  # (as num_eligible_attendees()). these are running totals, kept up to date by scan and mark_attendee_eligible,
+  # persisted in event_<name>_totals, and rebuilt from the status table by consistency_check.
+  #
+  # the totals row is read on every call, since other processes (e.g. bin/reset-congress-checkin.py) can change it. if
+  # it no longer matches what this process last saw, the change is cached as if we'd made it, so waiters in
+  # wait_for_change and anything keyed on version() notice. the exception is ingest mode, where queued scans aren't in
+  # the row yet, so this process's running totals are ahead of it; there, ScanIngest.is_current checks the row instead.
+  def totals(self):
+    with Event._totals_lock:
+      ingest = ScanIngest.shared()
+      if ingest.enabled() and self.name in Event._totals and ingest.is_current(self):
+        return dict(Event._totals[self.name])
+
+      db = Database.shared()
+      result = db.query(f"SELECT total_attendees_scanned, total_scannable FROM event_{self.name}_totals WHERE id = 1")
+      if not result:
+        return dict(self.rebuild_totals())
+
+      totals = result[0]
+      if totals != Event._totals.get(self.name) and not db.in_batch(): # inside a batch, the row may not be committed yet
+        if self.name in Event._totals:
+          log.debug(f"Totals for event {self.name} were changed by another process: {totals}")
+        self.cache_totals(totals)
+      return dict(totals)
+
+  # apply changes to the persisted totals as part of the current transaction, and return the new totals. the caller
+  # must hold _totals_lock, and hand the result to cache_totals once the changes are committed.
+  def adjust_totals(self, scanned=0, scannable=0):
+    if scanned == 0 and scannable == 0:
+      return self.totals()
+
+    db = Database.shared()
+    totals_table = f"event_{self.name}_totals"
+    db.execute(f"UPDATE {totals_table} SET total_attendees_scanned = total_attendees_scanned + ?, total_scannable = total_scannable + ? WHERE id = 1",
+              [scanned, scannable])
+    return db.query(f"SELECT total_attendees_scanned, total_scannable FROM {totals_table} WHERE id = 1")[0]
+
+  def cache_totals(self, totals):
+    with Event._totals_lock:
+      Event._totals[self.name] = totals
+
+    with Event._version_lock:
+      Event._versions[self.name] = Event._versions.get(self.name, 0) + 1
+      if self.name in Event._changed:
+        Event._changed[self.name].notify_all()
+
+  # return a counter that increases every time the named event's totals are updated, for use with wait_for_change
+  @classmethod
+  def version(cls, name):
+    with cls._version_lock:
+      return cls._versions.get(name, 0)
+
+  # block until the named event's version differs from the one given, or timeout seconds pass; returns the current
+  # version either way. changes made by other processes are noticed by a single shared poller, however many waiters
+  # there are.
+  @classmethod
+  def wait_for_change(cls, name, version, timeout):
+    with cls._version_lock:
+      if name not in cls._changed:
+        cls._changed[name] = threading.Condition(cls._version_lock)
+      if cls._poller is None:
+        cls._poller = threading.Thread(target=cls.poll_for_external_changes, daemon=True)
+        cls._poller.start()
+
+      cls._waiters[name] = cls._waiters.get(name, 0) + 1
+      try:
+        cls._changed[name].wait_for(lambda: cls._versions.get(name, 0) != version, timeout)
+      finally:
+        cls._waiters[name] -= 1
+      return cls._versions.get(name, 0)
+
+  # re-read the totals of every event that has waiters, once per EXTERNAL_POLL_INTERVAL. totals() caches (and so bumps
+  # the version and wakes the waiters) if another process changed them. this is one query per event, not per waiter,
+  # and none at all while nobody's waiting.
+  @classmethod
+  def poll_for_external_changes(cls):
+    while True:
+      time.sleep(cls.EXTERNAL_POLL_INTERVAL)
+      with cls._version_lock:
+        names = [name for name, count in cls._waiters.items() if count > 0]
+      for name in names:
+        try:
+          Event(name).totals()
+        except Exception as exc:
+          log.warn(f"Encountered an exception checking event {name} for changes", exception=exc)
+
+  # recount the totals from the status table, and store them
+  def rebuild_totals(self):
+    with Event._totals_lock:
+      with Database.shared().batch():
+        totals = self.recount_totals()
+      self.cache_totals(totals) # only once committed
+    return totals
+
+  # count the totals from the status table and store them in the totals row, as part of the current transaction
+  def recount_totals(self):
     db = Database.shared()
     status_table = f"event_{self.name}_status"
-    
+
+    totals = db.query(f"""
+      SELECT COALESCE(SUM(scan_count > 0), 0) AS total_attendees_scanned,
+        COALESCE(SUM(is_eligible = TRUE OR scan_count > 0), 0) AS total_scannable
+      FROM {status_table}
+    """)[0]
+    db.execute(f"INSERT OR REPLACE INTO event_{self.name}_totals (id, total_attendees_scanned, total_scannable) VALUES (1, ?, ?)",
+              [totals['total_attendees_scanned'], totals['total_scannable']])
+    return totals
+
+  def num_scanned_attendees(self, include_ineligible=True):
     if include_ineligible:
-      result = db.query(f"SELECT COUNT(*) as count FROM {status_table} WHERE scan_count > 0")
-    else:
-      result = db.query(f"SELECT COUNT(*) as count FROM {status_table} WHERE scan_count > 0 AND is_eligible = TRUE")
-    
+      return self.totals()['total_attendees_scanned']
+
+    db = Database.shared()
+    status_table = f"event_{self.name}_status"
+    result = db.query(f"SELECT COUNT(*) as count FROM {status_table} WHERE scan_count > 0 AND is_eligible = TRUE")
     return result[0]['count']
 
   def num_eligible_attendees(self, include_all_scanned=True):
+    if include_all_scanned:
+      return self.totals()['total_scannable']
+
     db = Database.shared()
     status_table = f"event_{self.name}_status"
-    
-    if include_all_scanned:
-      result = db.query(f"SELECT COUNT(*) as count FROM {status_table} WHERE is_eligible = TRUE OR scan_count > 0")
-    else:
-      result = db.query(f"SELECT COUNT(*) as count FROM {status_table} WHERE is_eligible = TRUE")
-    
+    result = db.query(f"SELECT COUNT(*) as count FROM {status_table} WHERE is_eligible = TRUE")
     return result[0]['count']
 
   def ensure_db(self):
+    if self.name in Event._ensured:
+      return
     db = Database.shared()
     
     # Create status table
@@ -182,81 +372,74 @@ class Event:
     """)
     db.execute(f"CREATE INDEX IF NOT EXISTS idx_{enrollments_table}_timestamp ON {enrollments_table} (badgefile_id, timestamp_changed)")
 
+    # Create totals table, holding a single row of running totals (see totals())
+    totals_table = f"event_{self.name}_totals"
+    db.execute(f"""
+      CREATE TABLE IF NOT EXISTS {totals_table} (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_attendees_scanned INTEGER NOT NULL DEFAULT 0,
+        total_scannable INTEGER NOT NULL DEFAULT 0
+      )
+    """)
+    if not db.query(f"SELECT id FROM {totals_table} WHERE id = 1"):
+      self.rebuild_totals()
+    Event._ensured.add(self.name)
+
+  # rebuild the status table (and totals) from the enrollments and scans tables, in one transaction
   def consistency_check(self):
-    self.consistency_check_enrollments()
-    self.consistency_check_scans()
+    with Event._totals_lock:
+      ScanIngest.shared().reset(self.name) # queued scans go in the scans table first; in-memory state is reloaded after
+      with Database.shared().batch():
+        self.consistency_check_enrollments()
+        self.consistency_check_scans()
+        totals = self.recount_totals()
+      self.cache_totals(totals) # only once committed
 
   def consistency_check_enrollments(self):
-    # for each unique badgegile_id from enrollments:
-    #   select most recent row from enrollments for that id
-    #   update row in status to ensure is_eligible is consistent with value from most recent enrollments row
-    #   create row in status if no such row exists, with scan_count=0
+    # for each badgefile_id in enrollments, make sure the status row exists and its is_eligible matches the most
+    # recent enrollment (creating the row with scan_count=0 if needed)
     db = Database.shared()
     enrollments_table = f"event_{self.name}_enrollments"
     status_table = f"event_{self.name}_status"
-    
-    # Get unique badgefile_ids from enrollments
-    unique_ids = db.query(f"SELECT DISTINCT badgefile_id FROM {enrollments_table}")
-    
-    for id_row in unique_ids:
-      badgefile_id = id_row['badgefile_id']
-      
-      # Get most recent enrollment record for this badgefile_id
-      latest_enrollment = db.query(f"""
-        SELECT is_eligible FROM {enrollments_table} 
-        WHERE badgefile_id = ? 
-        ORDER BY timestamp_changed DESC 
-        LIMIT 1
-      """, [badgefile_id])
-      
-      if latest_enrollment:
-        is_eligible = latest_enrollment[0]['is_eligible']
-        
-        # Check if attendee exists in status table
-        status_row = db.query(f"SELECT * FROM {status_table} WHERE badgefile_id = ?", [badgefile_id])
-        
-        if status_row:
-          # Update existing row
-          db.execute(f"UPDATE {status_table} SET is_eligible = ? WHERE badgefile_id = ?", 
-                    [is_eligible, badgefile_id])
-        else:
-          # Create new row
-          db.execute(f"INSERT INTO {status_table} (badgefile_id, scan_count, is_eligible) VALUES (?, 0, ?)",
-                    [badgefile_id, is_eligible])
+
+    db.execute(f"""
+      WITH latest_enrollments AS (
+        SELECT badgefile_id, is_eligible,
+          ROW_NUMBER() OVER (PARTITION BY badgefile_id ORDER BY timestamp_changed DESC, enrollment_id DESC) AS recency
+        FROM {enrollments_table}
+      )
+      INSERT INTO {status_table} (badgefile_id, scan_count, is_eligible)
+      SELECT badgefile_id, 0, is_eligible FROM latest_enrollments WHERE recency = 1
+      ON CONFLICT(badgefile_id) DO UPDATE SET is_eligible = excluded.is_eligible
+    """)
 
   def consistency_check_scans(self):
-    from log.logger import log
-    
+    # for each badgefile_id in scans, set the status row's scan_count to the number of scans since the most recent reset
     db = Database.shared()
     scans_table = f"event_{self.name}_scans"
     status_table = f"event_{self.name}_status"
-    
-    # Get unique badgefile_ids from scans
-    unique_ids = db.query(f"SELECT DISTINCT badgefile_id FROM {scans_table}")
-    
-    for id_row in unique_ids:
-      badgefile_id = id_row['badgefile_id']
-      
-      # Get all scans for this badgefile_id ordered by timestamp
-      scans = db.query(f"""
-        SELECT is_reset FROM {scans_table} 
-        WHERE badgefile_id = ? 
-        ORDER BY timestamp_scanned ASC
-      """, [badgefile_id])
-      
-      # Calculate correct scan count
-      counter = 0
-      for scan in scans:
-        if not scan['is_reset']:
-          counter += 1
-        else:
-          counter = 0
-      
-      # Ensure status table is consistent
-      status_row = db.query(f"SELECT * FROM {status_table} WHERE badgefile_id = ?", [badgefile_id])
-      
-      if status_row:
-        db.execute(f"UPDATE {status_table} SET scan_count = ? WHERE badgefile_id = ?", 
-                  [counter, badgefile_id])
-      else:
-        log.warn(f"No status row found for badgefile_id {badgefile_id} in event {self.name}, but has scan count of {counter} after {len(scans)} scan rows")
+
+    db.execute(f"""
+      WITH ordered_scans AS (
+        SELECT badgefile_id, is_reset,
+          SUM(is_reset) OVER (PARTITION BY badgefile_id ORDER BY timestamp_scanned, scan_id) AS resets_so_far,
+          SUM(is_reset) OVER (PARTITION BY badgefile_id) AS total_resets
+        FROM {scans_table}
+      ),
+      scan_counts AS (
+        SELECT badgefile_id, SUM(resets_so_far = total_resets AND NOT is_reset) AS scan_count
+        FROM ordered_scans
+        GROUP BY badgefile_id
+      )
+      UPDATE {status_table} SET scan_count = scan_counts.scan_count
+      FROM scan_counts
+      WHERE {status_table}.badgefile_id = scan_counts.badgefile_id
+    """)
+
+    orphans = db.query(f"""
+      SELECT badgefile_id, COUNT(*) AS num_scans FROM {scans_table}
+      WHERE badgefile_id NOT IN (SELECT badgefile_id FROM {status_table})
+      GROUP BY badgefile_id
+    """)
+    for orphan in orphans:
+      log.warn(f"No status row found for badgefile_id {orphan['badgefile_id']} in event {self.name}, but has {orphan['num_scans']} scan rows")
@@ -117,6 +117,15 @@ class IdManager:
       return badgefile_id
     return rows[0]["canonical_badgefile_id"]
   
+  # return every badgefile_id whose canonical_id is the given one, including the canonical ID itself unless it is
+  # itself an alias of some other ID
+  def ids_with_canonical_id(self, canonical_id):
+    canonical_id = int(canonical_id)
+    aliases = [row["badgefile_id"] for row in Database.shared().query("SELECT badgefile_id FROM BadgefileIdMaps WHERE canonical_badgefile_id=?", [canonical_id])]
+    if canonical_id not in aliases and self.canonical_id(canonical_id) == canonical_id:
+      aliases.insert(0, canonical_id)
+    return aliases
+
   def issue_id(self, userhash):
     Database.shared().execute("INSERT INTO GuestIdMaps (userhash) VALUES (?)", [userhash])
     return Database.shared().last_id()
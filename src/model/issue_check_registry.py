@@ -0,0 +1,101 @@
+import importlib.util
+import os
+import threading
+import time
+
+from log.logger import log
+
+class IssueCheck:
+  """A single loaded issue check script from model/issue_checks."""
+
+  def __init__(self, issue_type, path, mtime, run_check, inputs=None):
+    self.issue_type = issue_type
+    self.path = path
+    self.mtime = mtime
+    self.run_check = run_check
+    self.inputs = inputs # list of IssueCheckRegistry.INPUTS the check reads, or None if it didn't declare them
+
+class IssueCheckRegistry:
+  """Discovers and imports the issue check scripts once per process, keeping their run_check functions so that scanning
+  an attendee doesn't recompile every check. A check is reloaded only when its file's mtime changes.
+
+  Each check may declare the attendee data it reads in a module-level INPUTS list, so that scans can skip checks whose
+  inputs haven't changed (see Attendee.run_issue_checks). Checks that don't declare INPUTS are always run."""
+
+  # "info": the attendee's own info, including local overrides
+  # "party": the info of everyone in the attendee's party, including the primary registrant
+  # "activities": the attendee's activities, and those of their primary registrant
+  # "payments": the attendee's congress and housing payment lines
+  # "reglist": the latest reglist
+  # "youth_forms": the attendee's response on the youth form sheet
+  INPUTS = ["info", "party", "activities", "payments", "reglist", "youth_forms"]
+
+  _shared = None
+
+  @classmethod
+  def shared(cls):
+    if cls._shared is None:
+      cls._shared = cls()
+    return cls._shared
+
+  def __init__(self, directory=None, refresh_interval=2.0):
+    self.directory = directory or os.path.join(os.path.dirname(os.path.abspath(__file__)), "issue_checks")
+    self.refresh_interval = refresh_interval # seconds between checks of the directory for new or modified files
+    self._checks = {} # issue_type -> IssueCheck
+    self._last_refresh = None
+    self._lock = threading.Lock()
+
+  # return a list of IssueChecks, sorted by issue type, picking up any check files that were added, changed or removed
+  # since the last refresh (at most once per refresh_interval)
+  def checks(self):
+    if self._last_refresh is None or time.time() - self._last_refresh > self.refresh_interval:
+      self.refresh()
+    return [self._checks[issue_type] for issue_type in sorted(self._checks)]
+
+  def refresh(self):
+    with self._lock:
+      found = set()
+      for filename in os.listdir(self.directory):
+        if "__" in filename or not filename.endswith(".py"):
+          continue
+
+        issue_type = filename[:-3]  # Strip .py extension
+        path = os.path.join(self.directory, filename)
+        mtime = os.path.getmtime(path)
+        found.add(issue_type)
+
+        existing = self._checks.get(issue_type)
+        if existing is not None and existing.mtime == mtime:
+          continue
+
+        check = self.load(issue_type, path, mtime)
+        if check is None:
+          self._checks.pop(issue_type, None)
+        else:
+          self._checks[issue_type] = check
+
+      for issue_type in set(self._checks) - found:
+        log.debug(f"Issue check {issue_type} was removed")
+        del self._checks[issue_type]
+
+      self._last_refresh = time.time()
+
+  def load(self, issue_type, path, mtime):
+    start_time = time.time()
+    spec = importlib.util.spec_from_file_location(issue_type, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    import_time_ms = (time.time() - start_time) * 1000
+
+    if not hasattr(module, "run_check"):
+      log.debug(f"Issue check {issue_type} has no run_check function (import only: {import_time_ms:.2f} ms)")
+      return None
+
+    inputs = getattr(module, "INPUTS", None)
+    unknown_inputs = [input for input in inputs or [] if input not in self.INPUTS]
+    if len(unknown_inputs) > 0:
+      log.warn(f"Issue check {issue_type} declares unknown INPUTS {unknown_inputs}; it will be run for every scan")
+      inputs = None
+
+    log.trace(f"Loaded issue check {issue_type} in {import_time_ms:.2f} ms")
+    return IssueCheck(issue_type, path, mtime, module.run_check, inputs)
@@ -1,5 +1,7 @@
 from datetime import datetime
 
+INPUTS = ["info", "party", "activities"]
+
 def run_check(attendee):
   if not attendee.is_primary():
     return None
@@ -1,3 +1,5 @@
+INPUTS = ["info", "payments"]
+
 def run_check(attendee):
   balance_due = attendee.congress_balance_due()
   if balance_due > 0:
@@ -1,3 +1,5 @@
+INPUTS = ["info", "activities", "payments"]
+
 def run_check(attendee):
   balance_due = attendee.housing_balance_due()
   if balance_due > 0:
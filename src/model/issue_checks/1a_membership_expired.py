@@ -1,5 +1,7 @@
 from datetime import datetime
 
+INPUTS = ["info"]
+
 def run_check(attendee):
   # TODO: find out actual cutoff, and determine if we're testing expdate < cutoff or expdate <= cutoff
   expdate = attendee.membership_expiration()
@@ -1,3 +1,5 @@
+INPUTS = ["info", "activities"]
+
 def run_check(attendee):
   regs = [x for x in attendee.activities() if "registration fee" in x.info()['activity_title'].lower()]
   if len(regs) >= 2:
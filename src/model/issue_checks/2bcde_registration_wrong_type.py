@@ -1,5 +1,7 @@
 from datetime import datetime
 
+INPUTS = ["info"]
+
 def run_check(attendee):
   type = attendee.info()['regtype'].lower()
   dob = attendee.date_of_birth()
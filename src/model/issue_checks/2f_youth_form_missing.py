@@ -1,5 +1,7 @@
 from datetime import datetime
 
+INPUTS = ["info", "youth_forms"]
+
 def run_check(attendee):
   if attendee.still_needs_youth_form():
     return {'msg': "Youth form required", 'category': 'youthform', 'code': '2d'}
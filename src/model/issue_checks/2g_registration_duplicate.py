@@ -1,3 +1,7 @@
+from model.attendee import Attendee
+
+INPUTS = ["info", "reglist"]
+
 def run_check(attendee):
   rrbid = attendee.reglist_cacher().reglist_rows_by_id(attendee.latest_reglist(), attendee.badgefile())
   if not attendee.id() in rrbid:
@@ -9,7 +13,9 @@ def run_check(attendee):
   if len(active) < 2:
     return None
 
-  all_regs = [attendee.__class__(attendee.badgefile).load_reglist_row(row) for row in active]
+  # describe each registration with a throwaway Attendee that's never saved. don't copy attendee's class: on a worker
+  # thread, attendee is a snapshot, which can't be loaded from a reglist row
+  all_regs = [Attendee(attendee.badgefile()).load_reglist_row(dict(row), sync=False) for row in active]
   reg_details = [ {
     'transrefnum': reg.info()['transrefnum'],
     'regtime': reg.info()['regtime'],
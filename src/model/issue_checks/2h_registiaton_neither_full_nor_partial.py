@@ -1,3 +1,5 @@
+INPUTS = ["info", "activities"]
+
 def run_check(attendee):
   if attendee.is_cancelled():
     return None
@@ -1,3 +1,5 @@
+INPUTS = ["info", "party", "activities"]
+
 def run_check(attendee):
   if not attendee.is_primary() or not attendee.party_housing():
     return None
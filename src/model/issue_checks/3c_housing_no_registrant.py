@@ -1,3 +1,5 @@
+INPUTS = ["info", "party", "activities"]
+
 def run_check(attendee):
   has_housing = any(activity.is_housing() for activity in attendee.activities())
   has_registration = attendee.primary() is not None
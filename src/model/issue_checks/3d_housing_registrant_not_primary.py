@@ -1,3 +1,5 @@
+INPUTS = ["info", "activities"]
+
 def run_check(attendee):
    # this issue should only show under a non-primary registrant who booked housing
   if not attendee.party_housing():
@@ -1,3 +1,5 @@
+INPUTS = ["info", "party", "activities"]
+
 def run_check(attendee):
   # this issue should show for anyone who doesn't have housing + hasn't said they're staying off-campus
   if attendee.party_housing():
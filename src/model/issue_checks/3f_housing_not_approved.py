@@ -1,3 +1,5 @@
+INPUTS = ["info", "party", "activities"]
+
 def run_check(attendee):
   # this issue should show for anyone who registered for housing but isn't approved yet
 
@@ -1,3 +1,5 @@
+INPUTS = ["info"]
+
 def run_check(attendee):
   if float(attendee.info()["registrant_fees"]) > 2000 and attendee.is_primary():
     return {
@@ -1,3 +1,5 @@
+INPUTS = ["info", "party"]
+
 def run_check(attendee):
   party = attendee.party()
   if len(party) >= 5:
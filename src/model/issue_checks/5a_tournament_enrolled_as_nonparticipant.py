@@ -1,3 +1,5 @@
+INPUTS = ["info"]
+
 def run_check(attendee):
   tournaments = attendee.tournaments()
   if len(tournaments) > 0 and not attendee.is_participant():
@@ -1,5 +1,7 @@
 from datetime import datetime
 
+INPUTS = ["info"]
+
 def run_check(attendee):
   if not attendee.is_participant():
     return None
@@ -1,3 +1,5 @@
+INPUTS = ["info"]
+
 def run_check(attendee):
   if not attendee.is_participant():
     return None
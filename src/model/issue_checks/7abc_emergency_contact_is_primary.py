@@ -1,6 +1,8 @@
 
 import re
 
+INPUTS = ["info", "party"]
+
 def run_check(attendee):
   for check in [ check_name, check_phone, check_email ]:
     result = check(attendee)
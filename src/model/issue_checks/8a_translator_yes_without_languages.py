@@ -1,5 +1,7 @@
 from datetime import datetime
 
+INPUTS = ["info"]
+
 def run_check(attendee):
   info = attendee.info()
   if 'Yes' in str(info['translator']) and info['languages'] == None:
@@ -1,3 +1,5 @@
+INPUTS = ["info", "activities"]
+
 def run_check(attendee):
   banquet_regs = [x for x in attendee.activities() if x.is_banquet() and x.is_open()]
   if len(banquet_regs) > 1:
@@ -1,5 +1,7 @@
 from datetime import datetime
 
+INPUTS = ["info", "activities"]
+
 def run_check(attendee):
   dob = attendee.info()["date_of_birth"]  # dob is in mm/dd/yyyy format
   dob_date = datetime.strptime(dob, "%m/%d/%Y")
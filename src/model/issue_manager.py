@@ -6,7 +6,7 @@ class IssueManager:
   """Manages recording of each issue that is detected in attendee registrations."""
 
   _shared = None
-  
+
   @classmethod
   def shared(cls):
     if cls._shared is None:
@@ -35,28 +35,68 @@ class IssueManager:
         CREATE INDEX IF NOT EXISTS idx_badgefile_id_issue_type ON Issues (badgefile_id, issue_type)
     """)
 
+    # Add an index on (badgefile_id, status), for looking up open issues
+    Database.shared().execute("""
+        CREATE INDEX IF NOT EXISTS idx_badgefile_id_status ON Issues (badgefile_id, status)
+    """)
+
+    # Fingerprint of each check's inputs as of the last time it was run for each attendee (see Attendee.run_issue_checks)
+    Database.shared().execute("""
+        CREATE TABLE IF NOT EXISTS IssueCheckFingerprints (
+            badgefile_id INTEGER NOT NULL,
+            issue_type TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            PRIMARY KEY (badgefile_id, issue_type)
+        )
+    """)
+
   def open_issues_for_attendee(self, attendee):
     results = Database.shared().query("SELECT issue_type, issue_data FROM Issues WHERE badgefile_id=? AND status=0", [attendee.id()])
     return {row["issue_type"]: row["issue_data"] for row in results}
 
+  # return the open issues for every attendee in one query, as a dict of badgefile_id -> {issue_type: issue_data},
+  # in the same form as open_issues_for_attendee. attendees with no open issues are omitted.
+  def open_issues_by_badgefile_id(self):
+    issues = {}
+    rows = Database.shared().iter_query("SELECT badgefile_id, issue_type, issue_data FROM Issues WHERE status=0", row_factory="tuple")
+    for badgefile_id, issue_type, issue_data in rows:
+      issues.setdefault(badgefile_id, {})[issue_type] = issue_data
+    return issues
+
+  # return the stored issue check fingerprints for every attendee, as a dict of badgefile_id -> {issue_type: fingerprint}
+  def check_fingerprints_by_badgefile_id(self):
+    fingerprints = {}
+    rows = Database.shared().iter_query("SELECT badgefile_id, issue_type, fingerprint FROM IssueCheckFingerprints", row_factory="tuple")
+    for badgefile_id, issue_type, fingerprint in rows:
+      fingerprints.setdefault(badgefile_id, {})[issue_type] = fingerprint
+    return fingerprints
+
   def all_issues_for_attendee(self, attendee):
     results = Database.shared().query("SELECT issue_type, issue_data FROM Issues WHERE badgefile_id=?", [attendee.id()])
     return {row["issue_type"]: row["issue_data"] for row in results}
 
   def create(self, attendee, issue_type, issue_data):
-    issue_data_json = json.dumps(issue_data)
-    Database.shared().execute("INSERT INTO Issues (badgefile_id, issue_type, issue_data) VALUES (?, ?, ?)",
-                            [attendee.id(), issue_type, issue_data_json])
-    pass
+    self.apply(created=[[attendee, issue_type, issue_data]])
 
   def update(self, attendee, issue_type, issue_data):
-    issue_data_json = json.dumps(issue_data)
-    Database.shared().execute("UPDATE Issues SET issue_data=? WHERE badgefile_id=? AND issue_type=?",
-                            [issue_data_json, attendee.id(), issue_type])
+    self.apply(updated=[[attendee, issue_type, issue_data]])
 
   def resolve(self, attendee, issue_type):
-    Database.shared().execute("UPDATE Issues SET status=1, time_resolved=CURRENT_TIMESTAMP WHERE badgefile_id=? AND issue_type=?",
-                            [attendee.id(), issue_type])
-
+    self.apply(resolved=[[attendee, issue_type]])
 
+  # apply many issue changes in a single transaction. created and updated are lists of [attendee, issue_type, issue_data];
+  # resolved is a list of [attendee, issue_type]; fingerprints is a list of [attendee, issue_type, fingerprint] to store
+  # alongside them.
+  def apply(self, created=None, updated=None, resolved=None, fingerprints=None):
+    created_params = [[attendee.id(), issue_type, json.dumps(issue_data)] for attendee, issue_type, issue_data in created or []]
+    updated_params = [[json.dumps(issue_data), attendee.id(), issue_type] for attendee, issue_type, issue_data in updated or []]
+    resolved_params = [[attendee.id(), issue_type] for attendee, issue_type in resolved or []]
+    fingerprint_params = [[attendee.id(), issue_type, fingerprint] for attendee, issue_type, fingerprint in fingerprints or []]
 
+    db = Database.shared()
+    with db.batch():
+      db.executemany("INSERT INTO Issues (badgefile_id, issue_type, issue_data) VALUES (?, ?, ?)", created_params)
+      db.executemany("UPDATE Issues SET issue_data=? WHERE badgefile_id=? AND issue_type=? AND status=0", updated_params)
+      db.executemany("UPDATE Issues SET status=1, time_resolved=CURRENT_TIMESTAMP WHERE badgefile_id=? AND issue_type=? AND status=0", resolved_params)
+      db.executemany("""INSERT INTO IssueCheckFingerprints (badgefile_id, issue_type, fingerprint) VALUES (?, ?, ?)
+                        ON CONFLICT(badgefile_id, issue_type) DO UPDATE SET fingerprint=excluded.fingerprint""", fingerprint_params)
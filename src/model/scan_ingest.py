@@ -0,0 +1,199 @@
+import threading
+import time
+
+from integrations.database import Database
+from log.logger import log
+from util.secrets import secret
+
+class ScanIngestTimeout(Exception):
+  """Raised by ScanIngest.flush when queued scans aren't written in time."""
+  pass
+
+class ScanIngest:
+  """Optional write-behind queue for event scans, enabled with the scan_ingest_queue secret.
+
+  In ingest mode, Event.scan acknowledges a scan from in-memory state (each attendee's scan_count and is_eligible, plus
+  the event totals) and appends it to a queue; a single writer thread flushes the queue to event_<name>_scans,
+  event_<name>_status and event_<name>_totals in batched transactions, in the order the scans were accepted. Scans
+  acknowledged in the last flush_interval seconds before a crash are lost, but the tables are always consistent with
+  each other, and an event's in-memory state is recovered from its scans table (via Event.consistency_check) the first
+  time it's used.
+
+  The ingest process is expected to own the event tables while ingest mode is on, but other processes (e.g.
+  bin/reset-congress-checkin.py) may still change them. Each event's totals row is compared against the totals the
+  ingest last read or wrote whenever the state is used (see is_current); if they differ, the state is dropped and
+  reloaded. Outside changes that leave the totals as they were (such as re-marking an already scanned attendee
+  eligible) aren't noticed.
+
+  A batch the writer can't write after MAX_ATTEMPTS tries is logged and parked in self.parked, rather than retried
+  forever, and the state of the events it touched is dropped so they're reloaded from what actually made it to the
+  database."""
+
+  MAX_ATTEMPTS = 5 # tries at writing a batch before it's parked
+  RETRY_DELAY = 1.0 # seconds between tries
+  FLUSH_TIMEOUT = 30.0 # seconds flush() waits by default before raising ScanIngestTimeout
+
+  _shared = None
+
+  @classmethod
+  def shared(cls):
+    if cls._shared is None:
+      cls._shared = cls()
+    return cls._shared
+
+  def __init__(self, enabled=None, flush_interval=None, max_batch=1000):
+    self.is_enabled = bool(secret("scan_ingest_queue", False)) if enabled is None else enabled
+    self.flush_interval = float(secret("scan_ingest_flush_interval", 0.05)) if flush_interval is None else flush_interval
+    self.max_batch = max_batch # most scans written per transaction
+    self._states = {} # event name -> {"status": {badgefile_id: {"scan_count", "is_eligible"}}, "totals": {...}}
+    self._pending = [] # [event name, badgefile_id, timestamp_scanned, is_reset, scan_count], in the order accepted
+    self._num_queued = 0 # number of scans ever queued
+    self._num_flushed = 0 # number of those that have been written or parked
+    self.parked = [] # batches the writer gave up on, as [batch, exception]
+    self._persisted = {} # event name -> totals as the ingest last read them from, or wrote them to, the totals row
+    self._writing = False # whether the writer is part way through writing a batch
+    self._lock = threading.Condition() # reentrant; guards everything above, and notified whenever scans are queued or written
+    self._thread = None
+
+  def enabled(self):
+    return self.is_enabled
+
+  def start(self):
+    with self._lock:
+      if self._thread is None:
+        log.info(f"Starting scan ingest writer thread (flush interval {self.flush_interval}s)")
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+  # return the in-memory state of an event, loading it on first use (or after another process changed the event). the
+  # caller must hold Event._totals_lock.
+  def state(self, event):
+    if not self.is_current(event):
+      # the scans table is the record of every scan we've acknowledged and written, so rebuild the status and totals
+      # from it before trusting them
+      event.consistency_check()
+      rows = Database.shared().iter_query(f"SELECT badgefile_id, scan_count, is_eligible FROM event_{event.name}_status", row_factory="tuple")
+      status = {badgefile_id: {"scan_count": scan_count, "is_eligible": is_eligible} for badgefile_id, scan_count, is_eligible in rows}
+      totals = event.totals()
+      with self._lock:
+        self._states[event.name] = {"status": status, "totals": totals}
+        self._persisted[event.name] = dict(totals)
+      log.info(f"Loaded scan ingest state for event {event.name}: {len(status)} attendees")
+    return self._states[event.name]
+
+  # return whether the event's state is loaded and still matches the database, dropping it if another process has
+  # changed the event's totals row since we last read or wrote it. the caller must hold Event._totals_lock.
+  def is_current(self, event):
+    with self._lock:
+      if event.name not in self._states:
+        return False
+      if self._writing:
+        return True # the row is about to change under us, so we can't tell; the next call will
+
+      rows = Database.shared().query(f"SELECT total_attendees_scanned, total_scannable FROM event_{event.name}_totals WHERE id = 1")
+      if rows and rows[0] == self._persisted.get(event.name):
+        return True
+      log.info(f"Event {event.name} was changed by another process; reloading scan ingest state")
+      self._states.pop(event.name, None)
+      return False
+
+  # queue a scan whose effects on the attendee's scan_count and the event totals have already been worked out by
+  # Event.scan. the caller must hold Event._totals_lock, so scans are queued in the same order they're acknowledged.
+  def queue_scan(self, event, badgefile_id, timestamp_scanned, is_reset, scan_count, totals):
+    state = self.state(event)
+    with self._lock:
+      row = state["status"].setdefault(badgefile_id, {"scan_count": 0, "is_eligible": False})
+      row["scan_count"] = scan_count
+      state["totals"] = totals
+      self._pending.append([event.name, badgefile_id, timestamp_scanned, is_reset, scan_count])
+      self._num_queued += 1
+      self._lock.notify_all()
+    self.start()
+
+  # record a change that was written directly to the database (e.g. by mark_attendee_eligible), after flush()
+  def set_status(self, event, badgefile_id, scan_count, is_eligible, totals):
+    with self._lock:
+      state = self._states.get(event.name)
+      if state is None:
+        return # not loaded yet; it'll be loaded from the database, change included
+      state["status"][badgefile_id] = {"scan_count": scan_count, "is_eligible": is_eligible}
+      state["totals"] = totals
+      self._persisted[event.name] = dict(totals)
+
+  # block until every scan queued so far has been written (or parked), raising ScanIngestTimeout if that takes more than
+  # timeout seconds. callers typically hold Event._totals_lock, so this must not wait forever on a stuck writer.
+  def flush(self, timeout=None):
+    timeout = self.FLUSH_TIMEOUT if timeout is None else timeout
+    with self._lock:
+      target = self._num_queued
+      if target > self._num_flushed:
+        self.start()
+      if not self._lock.wait_for(lambda: self._num_flushed >= target, timeout):
+        raise ScanIngestTimeout(f"Timed out after {timeout}s waiting for queued scans to be written; {target - self._num_flushed} still pending")
+
+  # write every queued scan, then drop the event's in-memory state so it's reloaded from the database on next use
+  def reset(self, name):
+    self.flush()
+    with self._lock:
+      self._states.pop(name, None)
+
+  def run(self):
+    while True:
+      with self._lock:
+        self._lock.wait_for(lambda: len(self._pending) > 0)
+
+      # give concurrent scans a moment to pile up, so they share a transaction
+      time.sleep(self.flush_interval)
+
+      with self._lock:
+        batch = self._pending[:self.max_batch]
+        # totals as of the last scan in the batch; later scans are still pending, so these are the totals to persist
+        # only if the batch drains the queue for that event
+        totals = {name: dict(state["totals"]) for name, state in self._states.items()}
+        pending_names = set(entry[0] for entry in self._pending[len(batch):])
+        batch_names = set(entry[0] for entry in batch)
+        totals = {name: totals[name] for name in totals if name in batch_names and name not in pending_names}
+        self._writing = True
+
+      for attempt in range(1, self.MAX_ATTEMPTS + 1):
+        try:
+          start_time = time.time()
+          self.write(batch, totals)
+          log.debug(f"Wrote {len(batch)} queued scans in {1000*(time.time() - start_time):.1f}ms")
+          error = None
+          break
+        except Exception as exc:
+          error = exc
+          if attempt < self.MAX_ATTEMPTS:
+            log.warn(f"Error writing {len(batch)} queued scans on attempt #{attempt}/{self.MAX_ATTEMPTS}; will retry", exception=exc)
+            time.sleep(self.RETRY_DELAY)
+
+      with self._lock:
+        self._writing = False
+        if error is None:
+          self._persisted.update(totals)
+        else:
+          log.error(f"Giving up on writing {len(batch)} queued scans after {self.MAX_ATTEMPTS} attempts; parking them", data=batch, exception=error)
+          self.parked.append([batch, error])
+          # our in-memory state counts scans that never made it to the database, so reload it from the database
+          for name in set(entry[0] for entry in batch):
+            self._states.pop(name, None)
+        del self._pending[:len(batch)]
+        self._num_flushed += len(batch)
+        self._lock.notify_all()
+
+  def write(self, batch, totals):
+    db = Database.shared()
+    by_event = {}
+    for name, badgefile_id, timestamp_scanned, is_reset, scan_count in batch:
+      by_event.setdefault(name, []).append([badgefile_id, timestamp_scanned, is_reset, scan_count])
+
+    with db.batch():
+      for name, scans in by_event.items():
+        db.executemany(f"INSERT INTO event_{name}_scans (badgefile_id, timestamp_scanned, is_reset) VALUES (?, ?, ?)",
+                       [[badgefile_id, timestamp_scanned, is_reset] for badgefile_id, timestamp_scanned, is_reset, scan_count in scans])
+        db.executemany(f"UPDATE event_{name}_status SET scan_count = ? WHERE badgefile_id = ?",
+                       [[scan_count, badgefile_id] for badgefile_id, timestamp_scanned, is_reset, scan_count in scans])
+        if name in totals:
+          db.execute(f"UPDATE event_{name}_totals SET total_attendees_scanned = ?, total_scannable = ? WHERE id = 1",
+                     [totals[name]["total_attendees_scanned"], totals[name]["total_scannable"]])
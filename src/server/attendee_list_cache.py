@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+
+from log.logger import log
+from model.notification_manager import NotificationManager
+
+class AttendeeListCache:
+  """Keeps every attendee's web_info, pre-serialized, so GET /attendees can be answered from memory.
+
+  Entries are invalidated one attendee at a time by the notifications for scans, enrollments and attendee updates, and
+  recomputed on the next request. Every invalidation bumps the cache's version, which is recorded against the attendee
+  so clients can ask for just the attendees that changed since a version they've seen (see changes()). Versions start
+  from the current time in milliseconds, so they keep increasing across restarts."""
+
+  def __init__(self, badgefile, dumps=json.dumps):
+    self.badgefile = badgefile
+    self.dumps = dumps # serializer for each attendee's web_info; WebService passes its Flask app's, to match jsonify
+    self.version = int(time.time() * 1000)
+    self._reset_version = self.version # version as of the last time every entry was rebuilt
+    self._attendees = None # the badgefile's attendee list the entries were built from
+    self._entries = {} # badgefile_id -> [sort key, serialized web_info], or None for cancelled attendees
+    self._changed_at = {} # badgefile_id -> version at which the attendee was last invalidated
+    self._dirty = {} # badgefile_id -> attendee, for entries to recompute
+    self._body = None
+    self._lock = threading.Lock()
+
+    def received_notification(key, notification):
+      if key not in ["event", "attendee_update"]:
+        return
+      attendee = notification.get("attendee")
+      if attendee is not None:
+        self.invalidate(attendee)
+
+    NotificationManager.shared().observe(received_notification)
+
+  # mark an attendee's entry as stale (or add one for a new attendee), returning the new version; with no attendee,
+  # rebuild every entry
+  def invalidate(self, attendee=None):
+    with self._lock:
+      self.version += 1
+      if attendee is None:
+        self._attendees = None
+      else:
+        self._dirty[attendee.id()] = attendee
+        self._changed_at[attendee.id()] = self.version
+      self._body = None
+      return self.version
+
+  # return the version at which an attendee was last invalidated, or the current version if it hasn't been
+  def changed_version(self, attendee):
+    with self._lock:
+      return self._changed_at.get(attendee.id(), self.version)
+
+  # return the (unquoted) ETag of the current full list
+  def etag(self):
+    return f"attendees-{self.version}"
+
+  # return the serialized GET /attendees response body (the attendees' web_info, sorted by family name then given
+  # name, wrapped as WebService.respond does), its ETag and version
+  def body(self):
+    with self._lock:
+      self.refresh()
+      if self._body is None:
+        entries = sorted(entry for entry in self._entries.values() if entry is not None)
+        self._body = ('{"response": [' + ", ".join(serialized for sort_key, serialized in entries) + '], "status": 200}').encode('utf-8')
+      return self._body, self.etag(), self.version
+
+  # return the serialized GET /attendees?since=<since> response body: the web_info of attendees that changed after
+  # version since, the badgefile_ids of those that were removed or cancelled, and the current version. if since
+  # predates the last full rebuild (e.g. it's from before a restart), every attendee is included and "full" is true.
+  def changes(self, since):
+    with self._lock:
+      self.refresh()
+      full = since < self._reset_version or since > self.version
+      if full:
+        changed_ids = list(self._entries)
+      else:
+        changed_ids = [badgefile_id for badgefile_id, version in self._changed_at.items() if version > since]
+
+      entries = sorted(self._entries[badgefile_id] for badgefile_id in changed_ids if self._entries.get(badgefile_id) is not None)
+      removed = sorted(badgefile_id for badgefile_id in changed_ids if self._entries.get(badgefile_id) is None)
+      body = ('{"response": {"attendees": [' + ", ".join(serialized for sort_key, serialized in entries) + '], ' +
+              f'"full": {json.dumps(full)}, "removed": {json.dumps(removed)}, "version": {self.version}' + '}, "status": 200}')
+      return body.encode('utf-8'), self.version
+
+  # bring the entries up to date. the caller must hold _lock.
+  def refresh(self):
+    attendees = self.badgefile.attendees(include_cancelled=True)
+    if attendees is not self._attendees:
+      # the badgefile reloaded its attendees, so every entry refers to an old Attendee
+      if self._attendees is not None:
+        self.version += 1
+      self._reset_version = self.version
+      self._attendees = attendees
+      self._entries = {}
+      self._changed_at = {}
+      self._dirty = {attendee.id(): attendee for attendee in attendees}
+      self._body = None
+
+    if len(self._dirty) > 0:
+      for badgefile_id, attendee in self._dirty.items():
+        self._entries[badgefile_id] = self.entry(attendee)
+      log.debug(f"Refreshed {len(self._dirty)} of {len(self._entries)} attendees in attendee list")
+      self._dirty = {}
+
+  def entry(self, attendee):
+    if attendee.is_cancelled():
+      return None
+    info = attendee.web_info()
+    return [(info.get('name_family', ''), info.get('name_given', ''), attendee.id()), self.dumps(info)]
@@ -1,35 +1,55 @@
 import socket
+import selectors
 import threading
 import random
 import json
+import time
 
 from log.logger import log
 from util.secrets import secret
 from model.notification_manager import NotificationManager
 
 class SocketServer:
+  """Pushes event totals to LED signs over plain TCP. Each message is framed as "<length>|<json>\\n".
+
+  All socket I/O happens on one selector loop thread, so broadcast() never blocks the caller. Clients only need the
+  current state, so each client keeps at most one unsent message per key (the message type, plus the event name for
+  event messages): if a client falls behind, older messages it hasn't started receiving are replaced by the latest.
+  Clients that stop reading are disconnected, and idle connections are sent the latest event messages again so dead
+  peers are noticed. Signs drop any message type they don't know, so keepalives reuse the event message rather than
+  adding a new type; before any event has been broadcast there's nothing to resend, and TCP keepalive covers it."""
+
+  KEEPALIVE_INTERVAL = 30.0 # seconds without sending anything to a client before we resend it the latest events
+  WRITE_TIMEOUT = 60.0 # seconds a client can go without accepting any of its unsent data before it's disconnected
+  SELECT_TIMEOUT = 1.0 # seconds between checks for idle and stalled clients
+
   _instance = None
-  
+
   @classmethod
   def shared(cls):
     if cls._instance is None:
       cls._instance = cls()
     return cls._instance
-  
+
   def __init__(self, psk=None, interface=None, port=None):
     self.interface = interface or secret("socket_interface", "127.0.0.1")
     self.port = port or secret("socket_port", 8081)
     self.psk = psk or secret("socket_psk", "")
     self.clients = []
-    self.last_broadcast = None
+    self.latest = {} # message key -> most recently broadcast framed message with that key, sent to new clients
+    self._lock = threading.Lock() # guards clients, latest, and each client's pending messages
+    self._selector = None
+    self._wakeup_send = None # written to by broadcast, to wake the selector loop
 
     def received_notification(key, notification):
       if key != "event":
         return
-      
+
       event = notification.get("event")
-      num_scanned = event.num_scanned_attendees()
-      num_eligible_attendees = event.num_eligible_attendees()
+      data = notification.get("data", {})
+
+      # Event includes its totals in the notification; only query them if a notifier didn't
+      totals = data if "total_attendees_scanned" in data else event.totals()
 
       self.broadcast(
         {
@@ -37,62 +57,151 @@ class SocketServer:
           'data': {
             'event': {
               'name': event.name if hasattr(event, 'name') else None,
-              'total_attendees_scanned': num_scanned,
-              'total_scannable': num_eligible_attendees,
+              'total_attendees_scanned': totals['total_attendees_scanned'],
+              'total_scannable': totals['total_scannable'],
             }
          }
         }
       )
-    
+
     NotificationManager.shared().observe(received_notification)
 
-  def broadcast(self, msg):
+  def frame(self, msg):
     json_str = json.dumps(msg)
-    msg_raw = f"{len(json_str)}|{json_str}\n"
-    self.last_broadcast = msg_raw
+    return f"{len(json_str)}|{json_str}\n".encode('utf-8')
+
+  # return what identifies a message for coalescing: a newer message with the same key replaces an unsent older one.
+  # event messages are keyed by event name as well as type, so an update for one event never replaces another's.
+  def message_key(self, msg):
+    data = msg.get('data')
+    event = data.get('event') if isinstance(data, dict) else None
+    return (msg.get('type'), event.get('name') if isinstance(event, dict) else None)
+
+  # queue a message for every client and return without waiting for any of them to receive it
+  def broadcast(self, msg):
+    msg_key = self.message_key(msg)
+    msg_raw = self.frame(msg)
+
+    with self._lock:
+      self.latest.pop(msg_key, None) # keep latest in broadcast order, so resending it ends on the newest message
+      self.latest[msg_key] = msg_raw
+      log.debug(f"Broadcasting {len(msg_raw)} bytes to {len(self.clients)} socket clients: {msg}")
+      for client in self.clients:
+        client.queue(msg_key, msg_raw)
+    self.wake()
 
-    log.debug(f"Broadcasting {len(msg_raw)} bytes to {len(self.clients)} socket clients: {msg}")
-    for client in self.clients:
-      client.send(msg_raw)
+  def wake(self):
+    if self._wakeup_send is not None:
+      try:
+        self._wakeup_send.send(b'\0')
+      except BlockingIOError:
+        pass # the loop already has a wakeup waiting
 
   def listen(self):
     self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    
+
     try:
       self.server_socket.bind((self.interface, self.port))
       self.server_socket.listen(5)  # Allow up to 5 queued connections
+      self.server_socket.setblocking(False)
+
+      self._selector = selectors.DefaultSelector()
+      self._selector.register(self.server_socket, selectors.EVENT_READ, "accept")
+      self._wakeup_recv, self._wakeup_send = socket.socketpair()
+      self._wakeup_recv.setblocking(False)
+      self._wakeup_send.setblocking(False)
+      self._selector.register(self._wakeup_recv, selectors.EVENT_READ, "wakeup")
       log.info(f"Socket server listening on {self.interface}:{self.port}")
-      
-      # Create a thread for the listening loop
+
+      # Create a thread for the selector loop
       self.listen_thread = threading.Thread(target=self._listen_loop, daemon=True)
       self.listen_thread.start()
-      
+
     except Exception as e:
       log.error(f"Socket server error: {e}")
       self.server_socket.close()
-  
+
   def _listen_loop(self):
     try:
       while True:
-        client_socket, client_address = self.server_socket.accept()
-        client_ip, client_port = client_address
-        log.debug(f"New connection from {client_ip}:{client_port}; {len(self.clients)+1} clients total")
-
-        client = SocketClient(self, client_socket, client_ip, client_port)
-        if self.last_broadcast is not None:
-          client.send(self.last_broadcast)
-        self.clients.append(client)
-        
+        for key, mask in self._selector.select(self.SELECT_TIMEOUT):
+          if key.data == "accept":
+            self.accept()
+          elif key.data == "wakeup":
+            try:
+              while self._wakeup_recv.recv(4096):
+                pass
+            except BlockingIOError:
+              pass
+          else:
+            client = key.data
+            if mask & selectors.EVENT_READ:
+              client.receive()
+            if mask & selectors.EVENT_WRITE and not client.is_closed:
+              client.flush()
+
+        self.check_clients()
+
     except Exception as exc:
       log.error(f"Socket server loop error", exception=exc)
     finally:
       self.server_socket.close()
 
+  def accept(self):
+    try:
+      client_socket, client_address = self.server_socket.accept()
+    except BlockingIOError:
+      return
+    client_ip, client_port = client_address[0], client_address[1]
+    log.debug(f"New connection from {client_ip}:{client_port}; {len(self.clients)+1} clients total")
+
+    client_socket.setblocking(False)
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    client = SocketClient(self, client_socket, client_ip, client_port)
+    with self._lock:
+      for msg_key, msg_raw in self.latest.items():
+        client.queue(msg_key, msg_raw)
+      self.clients.append(client)
+    self._selector.register(client_socket, selectors.EVENT_READ, client)
+
+  # on the loop thread: send queued data, resend the latest events to idle clients as a keepalive, and disconnect
+  # clients that have stopped accepting data
+  def check_clients(self):
+    now = time.monotonic()
+    with self._lock:
+      clients = list(self.clients)
+
+    for client in clients:
+      if client.is_closed:
+        continue
+      if client.has_unsent() and now - client.last_progress > self.WRITE_TIMEOUT:
+        log.debug(f"Client {client.ip}:{client.port} hasn't accepted data in {self.WRITE_TIMEOUT}s; disconnecting")
+        client.close()
+        continue
+
+      if not client.has_unsent() and now - client.last_progress > self.KEEPALIVE_INTERVAL:
+        with self._lock:
+          for msg_key, msg_raw in self.latest.items():
+            if msg_key[0] == 'event':
+              client.queue(msg_key, msg_raw)
+        if not client.has_unsent():
+          client.last_progress = now # no events yet; leave dead peer detection to SO_KEEPALIVE
+
+      if client.has_unsent():
+        client.flush() # sends what it can now, and watches for writability if anything is left
+
   def disconnected(self, client):
-    if client in self.clients:
+    with self._lock:
+      if client not in self.clients:
+        return
       self.clients.remove(client)
-      log.debug(f"Client {client.ip}:{client.port} disconnected; {len(self.clients)} clients remaining")
+      remaining = len(self.clients)
+    try:
+      self._selector.unregister(client.socket)
+    except (KeyError, ValueError):
+      pass
+    log.debug(f"Client {client.ip}:{client.port} disconnected; {remaining} clients remaining")
 
 class SocketClient:
   def __init__(self, server, client_socket, client_ip, client_port):
@@ -100,23 +209,74 @@ class SocketClient:
     self.ip = client_ip
     self.port = client_port
     self.server = server
+    self.sending = None # memoryview of the rest of the message being sent, which must be finished to keep framing
+    self.pending = {} # message key (see SocketServer.message_key) -> framed message not yet started, oldest first
+    self.last_progress = time.monotonic() # when we last queued into an empty buffer, or sent any bytes
+    self.is_watching_writes = False
+    self.is_closed = False
 
     self._server_rand = random.getrandbits(128)
-  
-  def send(self, msg):
+
+  # queue a framed message, replacing any unsent message with the same key. the caller must hold the server's _lock.
+  def queue(self, msg_key, msg_raw):
+    if not self.has_unsent():
+      self.last_progress = time.monotonic()
+    self.pending.pop(msg_key, None)
+    self.pending[msg_key] = msg_raw
+
+  def has_unsent(self):
+    return self.sending is not None or len(self.pending) > 0
+
+  # on the loop thread: ask the selector to report when the socket is writable, or stop asking
+  def watch(self, writes):
+    if self.is_closed or writes == self.is_watching_writes:
+      return
+    events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writes else 0)
+    self.server._selector.modify(self.socket, events, self)
+    self.is_watching_writes = writes
+
+  # on the loop thread: send as much unsent data as the socket will take without blocking
+  def flush(self):
     try:
-      self.socket.sendall(msg.encode('utf-8'))
+      while True:
+        if self.sending is None:
+          with self.server._lock:
+            if len(self.pending) == 0:
+              break
+            msg_key = next(iter(self.pending))
+            self.sending = memoryview(self.pending.pop(msg_key))
+
+        sent = self.socket.send(self.sending)
+        self.last_progress = time.monotonic()
+        self.sending = self.sending[sent:] if sent < len(self.sending) else None
+    except BlockingIOError:
+      pass
     except (BrokenPipeError, ConnectionResetError, socket.error) as exc:
       log.debug(f"Client at {self.ip} seems disconnected; removing", exception=exc)
-      try:
-        self.socket.close()
-      except:
-        pass
-      self.server.disconnected(self)
-    except Exception as exc:
-      log.warn(f"Error sending message to client at {self.ip}; removing", exception=exc)
-      try:
-        self.socket.close()
-      except:
-        pass
-      self.server.disconnected(self)
+      self.close()
+      return
+    self.watch(self.has_unsent())
+
+  # on the loop thread: read whatever the client sent. signs don't send anything, so this is just how we notice that
+  # they've closed the connection.
+  def receive(self):
+    try:
+      data = self.socket.recv(4096)
+    except BlockingIOError:
+      return
+    except (ConnectionResetError, socket.error) as exc:
+      log.debug(f"Client at {self.ip} seems disconnected; removing", exception=exc)
+      self.close()
+      return
+    if not data:
+      self.close()
+
+  def close(self):
+    if self.is_closed:
+      return
+    self.is_closed = True
+    self.server.disconnected(self)
+    try:
+      self.socket.close()
+    except:
+      pass
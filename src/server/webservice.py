@@ -3,19 +3,27 @@ import json
 import os
 import re
 import base64
+import gzip
 import logging
 import time
 
-from flask import Flask, request, redirect, render_template, jsonify, abort, send_file
+from flask import Flask, Response, request, redirect, render_template, jsonify, abort, send_file
 from flask_sock import Sock
 from werkzeug.exceptions import NotFound
 
+try:
+  import brotli
+except ImportError:
+  brotli = None # optional; without it, responses are only ever gzipped
+
 from log.logger import log
 from util.version import Version
 from util.secrets import secret
 from model.event import Event, AttendeeNotEligible
 from model.local_attendee_overrides import LocalAttendeeOverrides
 from server.socketserver import SocketServer
+from server.attendee_list_cache import AttendeeListCache
+from server.websocket_broadcaster import WebsocketBroadcaster
 from model.notification_manager import NotificationManager
 
 class HTTPError(Exception):
@@ -26,6 +34,10 @@ class HTTPError(Exception):
     super().__init__(self.message)
 
 class WebService:
+  LONGPOLL_MAX_WAIT = 30.0 # seconds a /events/<event_name>/count request waits for a change before responding anyway
+  COMPRESS_MIN_SIZE = 1024 # JSON responses smaller than this many bytes aren't worth compressing
+  COMPRESSED_CACHE_SIZE = 32 # number of compressed responses with ETags kept, so unchanged payloads are compressed once
+
   def __init__(self, badgefile, listen_interface='127.0.0.1', port=8080):
     self.badgefile = badgefile
     self.listen_interface = listen_interface
@@ -36,9 +48,13 @@ class WebService:
     log = logging.getLogger('werkzeug')
     log.setLevel(logging.ERROR)
     self.sock = Sock(self.app)
-    self.websocket_clients = set()
+    self.websockets = WebsocketBroadcaster()
     self._setup_routes()
     self.recent_scans = {}
+    self.recent_scans_versions = {} # event name -> number of times recent_scans has changed, for ETags
+    self.attendee_list = AttendeeListCache(badgefile, dumps=self.app.json.dumps)
+    self.epoch = int(time.time() * 1000) # distinguishes this process's event ETags from those of earlier runs
+    self.compressed = {} # (path, ETag, encoding) -> compressed response body
 
     def received_notification(key, notification):
       if key != "event":
@@ -48,8 +64,8 @@ class WebService:
       attendee = notification.get("attendee")
       data = notification.get("data", {})
 
-      num_scanned = event.num_scanned_attendees()
-      num_eligible_attendees = event.num_eligible_attendees()
+      # Event includes its totals in the notification; only query them if a notifier didn't
+      totals = data if "total_attendees_scanned" in data else event.totals()
 
       response_data = {
         "attendee": attendee.web_info(),
@@ -57,14 +73,15 @@ class WebService:
           "name": event.name,
           "is_reset": data.get("is_reset"),
           "num_scans_for_attendee": data.get('num_times_attendee_scanned'),
-          "total_attendees_scanned": num_scanned,
-          "total_scannable": num_eligible_attendees,
+          "total_attendees_scanned": totals["total_attendees_scanned"],
+          "total_scannable": totals["total_scannable"],
         }
       }
 
       websocket_message = {
         "type": "scan", 
         "data": response_data,
+        "version": self.attendee_list.changed_version(attendee), # AttendeeListCache has already seen this notification
       }
 
       self.broadcast_to_websockets(websocket_message)
@@ -74,6 +91,7 @@ class WebService:
       self.recent_scans[event.name].append(websocket_message)
       while len(self.recent_scans[event.name]) > 20:
         self.recent_scans[event.name] = self.recent_scans[event.name][1:]
+      self.recent_scans_versions[event.name] = self.recent_scans_versions.get(event.name, 0) + 1
     
     NotificationManager.shared().observe(received_notification)
 
@@ -169,7 +187,7 @@ class WebService:
     response.status_code = status
     raise HTTPError(status, message, data)
 
-  def respond(self, response_obj, status=200):
+  def respond(self, response_obj, status=200, etag=None):
     wrapped_response = jsonify({
       "status": status,
       "response": response_obj,
@@ -177,7 +195,54 @@ class WebService:
 
     wrapped_response.status_code = status
     wrapped_response.mimetype = 'application/json'
+    if etag is not None:
+      wrapped_response.set_etag(etag)
     abort(wrapped_response)
+
+  # respond 304 Not Modified if the request's If-None-Match includes etag (unquoted), in any of our content codings
+  def check_not_modified(self, etag):
+    for tag in [etag, f"{etag}-gzip", f"{etag}-br"]:
+      if request.if_none_match.contains(tag):
+        response = Response(status=304)
+        response.set_etag(tag)
+        response.vary.add('Accept-Encoding')
+        abort(response)
+
+  # return the ETag for one of an event's resources, which changes whenever the event's scans or enrollments do
+  def event_etag(self, event_name, resource):
+    Event(event_name).totals() # picks up totals changed by other processes, which bumps the version
+    return f"{event_name}-{resource}-{self.epoch}-{Event.version(event_name)}"
+
+  # compress a successful JSON response with the best encoding the client accepts, reusing the last compression of
+  # the same ETag
+  def compress_response(self, response):
+    if response.status_code != 200 or response.direct_passthrough or response.mimetype != 'application/json':
+      return
+    if 'Content-Encoding' in response.headers:
+      return
+    response.vary.add('Accept-Encoding')
+
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if encoding is None:
+      return
+    data = response.get_data()
+    if len(data) < self.COMPRESS_MIN_SIZE:
+      return
+
+    etag, is_weak = response.get_etag()
+    key = (request.full_path, etag, encoding) if etag else None
+    compressed = self.compressed.get(key) if key else None
+    if compressed is None:
+      compressed = brotli.compress(data, quality=5) if encoding == 'br' else gzip.compress(data, compresslevel=6)
+      if key:
+        if len(self.compressed) >= self.COMPRESSED_CACHE_SIZE:
+          self.compressed.clear()
+        self.compressed[key] = compressed
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+      response.set_etag(f"{etag}-{encoding}", weak=is_weak) # each content coding is a different representation
   
   def handler_crashed(self, exc):
     log.error(self.logmsg(f"Handler crashed: {str(exc)}"), exception=exc)
@@ -190,18 +255,9 @@ class WebService:
     response.status_code = 500
     return response
 
+  # queue a message for every connected websocket; returns without waiting for any of them (see WebsocketBroadcaster)
   def broadcast_to_websockets(self, message):
-    closed_sockets = set()
-    log.debug(f"Broadcasting message of type {message.get('type')} to {len(self.websocket_clients)} websocket clients")
-    for ws in self.websocket_clients:
-      try:
-        ws.send(json.dumps(message))
-      except Exception as exc:
-        log.warn(f"Failed to send to websocket", exception=exc)
-        closed_sockets.add(ws)
-    
-    # Remove closed websockets
-    self.websocket_clients -= closed_sockets
+    self.websockets.broadcast(message)
 
   def _setup_routes(self):
     # Add a decorator to measure request processing time and log metrics
@@ -218,12 +274,14 @@ class WebService:
       else:
         process_time = 0
         
-      # Get request and response sizes
+      # Get request and response sizes, before and after compression
       request_size = request.content_length or 0
+      uncompressed_size = response.calculate_content_length() or 0
+      self.compress_response(response)
       response_size = response.calculate_content_length() or 0
       
       # Log the request metrics
-      log.debug(f"webreq {WebService.ip()} \"{request.method} {request.path}\" {response.status_code} {process_time:.1f}ms {request_size} {response_size}")
+      log.debug(f"webreq {WebService.ip()} \"{request.method} {request.path}\" {response.status_code} {process_time:.1f}ms {request_size} {response_size} {uncompressed_size}")
       
       return response
       
@@ -328,19 +386,14 @@ class WebService:
     @self.sock.route('/ws')
     def monitor(ws):
       # self.require_authentication()
-      self.websocket_clients.add(ws)
-      log.info(self.logmsg(f"WebSocket client connected, total clients: {len(self.websocket_clients)}"))
+      log.info(self.logmsg(f"WebSocket client connected, total clients: {self.websockets.num_clients() + 1}"))
       try:
-        # Keep the connection alive until client disconnects
-        while True:
-          # This will block until a message is received or the connection is closed
-          message = ws.receive()
-          # We're not expecting any messages from the client, but we could process them here
+        # Send broadcasts to this client from this thread until it disconnects
+        self.websockets.serve(ws)
       except Exception as exc:
         log.info(self.logmsg(f"WebSocket disconnected"), exception=exc)
       finally:
-        self.websocket_clients.discard(ws)
-        log.info(self.logmsg(f"WebSocket client disconnected, remaining clients: {len(self.websocket_clients)}"))
+        log.info(self.logmsg(f"WebSocket client disconnected, remaining clients: {self.websockets.num_clients()}"))
 
     @self.app.route('/events/<event_name>/scans', methods=['POST'])
     def event_scans_post(event_name):
@@ -367,30 +420,27 @@ class WebService:
       
       event = Event(event_name)
       try:
-        num_scans = event.scan_in_attendee(attendee, is_reset=is_reset)
+        scan_result = event.scan(attendee, is_reset=is_reset)
       except AttendeeNotEligible:
         self.fail_request(400, "Attendee not eligible", {"attendee": attendee.web_info()})
-      
-      total_scans_for_event = event.num_scanned_attendees()
-      total_eligible = event.num_eligible_attendees()
 
       response_data = {
         "attendee": attendee.web_info(),
         "event": {
           "name": event_name,
           "is_reset": is_reset,
-          "num_scans_for_attendee": num_scans,
-          "total_attendees_scanned": total_scans_for_event,
-          "total_scannable": total_eligible,
+          "num_scans_for_attendee": scan_result["num_times_attendee_scanned"],
+          "total_attendees_scanned": scan_result["total_attendees_scanned"],
+          "total_scannable": scan_result["total_scannable"],
         }
       }
 
-      # Broadcast scan event to all connected websocket clients
+      # websocket clients get the scan from our NotificationManager observer
       websocket_message = {
         "type": "scan", 
         "data": response_data,
+        "version": self.attendee_list.changed_version(attendee),
       }
-      self.broadcast_to_websockets(websocket_message)
       SocketServer.shared().broadcast(websocket_message)
 
       self.respond(response_data)
@@ -403,13 +453,15 @@ class WebService:
         self.fail_request(404, "Event not found")
       
       event = Event(event_name)
+      etag = self.event_etag(event_name, "scans") # before reading the scans, so the ETag can't be newer than them
+      self.check_not_modified(etag)
 
       self.respond({
         "event": {
           "name": event_name,
           "scans": event.scan_counts(),
         }
-      })
+      }, etag=etag)
 
     @self.app.route('/events/<event_name>/scans/recent', methods=['GET'])
     def event_scans_recent_get(event_name):
@@ -418,8 +470,9 @@ class WebService:
       if not Event.exists(event_name):
         self.fail_request(404, "Event not found")
       
-      event = Event(event_name)
-      self.respond(self.recent_scans.get(event_name, []))
+      etag = f"{event_name}-recent-{self.epoch}-{self.recent_scans_versions.get(event_name, 0)}"
+      self.check_not_modified(etag)
+      self.respond(self.recent_scans.get(event_name, []), etag=etag)
     
     @self.app.route('/events/<event_name>/status', methods=['GET'])
     def event_status_get(event_name):
@@ -429,16 +482,17 @@ class WebService:
         self.fail_request(404, "Event not found")
       
       event = Event(event_name)
-      total_scans_for_event = event.num_scanned_attendees()
-      total_eligible = event.num_eligible_attendees()
+      etag = self.event_etag(event_name, "status")
+      self.check_not_modified(etag)
+      totals = event.totals()
 
       self.respond({
         "event": {
           "name": event_name,
-          "total_attendees_scanned": total_scans_for_event,
-          "total_scannable": total_eligible,
+          "total_attendees_scanned": totals["total_attendees_scanned"],
+          "total_scannable": totals["total_scannable"],
         }
-      })
+      }, etag=etag)
     
     @self.app.route('/events/<event_name>/count', methods=['GET'])
     def event_count_get(event_name):
@@ -449,13 +503,12 @@ class WebService:
 
       def make_response():
         event = Event(event_name)
-        total_scans_for_event = event.num_scanned_attendees()
-        total_eligible = event.num_eligible_attendees()
+        totals = event.totals()
 
         event_data = {
           "name": event_name,
-          "total_attendees_scanned": total_scans_for_event,
-          "total_scannable": total_eligible,
+          "total_attendees_scanned": totals["total_attendees_scanned"],
+          "total_scannable": totals["total_scannable"],
         }
 
         # Serialize event_data to JSON
@@ -468,35 +521,44 @@ class WebService:
 
       # Get the hash query parameter if provided, otherwise set to None
       last_hash = request.args.get('hash', None)
+      deadline = time.time() + self.LONGPOLL_MAX_WAIT
 
       while True:
-        # if 'hash' was provided, then don't return a response until we have an updated object
+        # if 'hash' was provided, then don't return a response until we have an updated object (or we time out, in
+        # which case the client gets the unchanged object and polls again)
+        version = Event.version(event_name) # read before building the response, so we can't miss a change in between
         rr = make_response()
-        if rr["hash"] != last_hash:
+        remaining = deadline - time.time()
+        if rr["hash"] != last_hash or remaining <= 0:
           self.respond(rr)
           break # shouldn't be needed, but let's be safe
-        
-        # Sleep for 100ms before checking again
-        time.sleep(0.1)
+
+        # Sleep until the event's totals are updated (including by another process; see Event.wait_for_change)
+        Event.wait_for_change(event_name, version, remaining)
 
     @self.app.route('/attendees', methods=['GET'])
     def attendees_get():
       # self.require_authentication()
       
-      # Get all attendees from the badgefile
-      attendees = self.badgefile.attendees()
-      
-      # Convert attendee objects to web-friendly format
-      attendees_data = []
-      for attendee in attendees:
-        log.debug(f"attendee: {attendee.full_name()} {attendee.id()}")
-        attendee_info = attendee.web_info()
-        attendees_data.append(attendee_info)
-      
-      # Sort attendees by family name, then given name
-      attendees_data.sort(key=lambda x: (x.get('name_family', ''), x.get('name_given', '')))
-      
-      self.respond(attendees_data)
+      since = request.args.get('since')
+      if since is not None:
+        # just the attendees that changed after version since, for clients that already have the list
+        try:
+          since = int(since)
+        except ValueError:
+          self.fail_request(400, "Invalid since - must be an integer")
+        body, version = self.attendee_list.changes(since)
+        response = Response(body, mimetype='application/json')
+        response.headers['X-Attendees-Version'] = str(version)
+        return response
+
+      # every attendee's web_info, sorted by family name then given name, served from memory (see AttendeeListCache)
+      body, etag, version = self.attendee_list.body() # cheap unless something changed
+      self.check_not_modified(etag)
+      response = Response(body, mimetype='application/json')
+      response.set_etag(etag)
+      response.headers['X-Attendees-Version'] = str(version)
+      return response
 
     @self.app.route('/attendees', methods=['POST'])
     def attendees_post():
@@ -623,13 +685,15 @@ class WebService:
 
       attendee_info = attendee.web_info()
 
+      # notify first, so the message can carry the version AttendeeListCache recorded for this change
+      NotificationManager.shared().notify("attendee_update", {"attendee": attendee})
       websocket_message = {
         "type": "attendee_update", 
         "data": attendee_info,
+        "version": self.attendee_list.changed_version(attendee),
       }
 
       self.broadcast_to_websockets(websocket_message)
-      NotificationManager.shared().notify("attendee_update", {"attendee": attendee})
 
       self.respond(override_result)
 
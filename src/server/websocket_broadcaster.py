@@ -0,0 +1,126 @@
+import json
+import threading
+
+from log.logger import log
+
+class WebsocketClient:
+  """A connected websocket, and the serialized messages queued for it."""
+
+  def __init__(self, ws, max_queue):
+    self.ws = ws
+    self.max_queue = max_queue
+    self.queue = [] # [coalesce key, payload] entries, oldest first
+    self.queued_by_key = {} # coalesce key -> the entry in queue carrying it
+    self.is_closed = False
+    self.was_dropped = False
+    self._lock = threading.Condition()
+
+  # queue a payload for sending, replacing any still-queued payload with the same coalesce key (the new one goes to the
+  # back, so it isn't sent ahead of messages queued before it). returns False, without queueing anything, if the queue
+  # is full.
+  def put(self, key, payload):
+    with self._lock:
+      if key is not None and key in self.queued_by_key:
+        self.queue.remove(self.queued_by_key.pop(key))
+      if len(self.queue) >= self.max_queue:
+        return False
+
+      entry = [key, payload]
+      self.queue.append(entry)
+      if key is not None:
+        self.queued_by_key[key] = entry
+      self._lock.notify_all()
+      return True
+
+  # return every queued payload, waiting up to timeout seconds for one if there are none
+  def take(self, timeout):
+    with self._lock:
+      self._lock.wait_for(lambda: len(self.queue) > 0 or self.is_closed, timeout)
+      entries = self.queue
+      self.queue = []
+      self.queued_by_key = {}
+      return [payload for key, payload in entries]
+
+  def close(self, dropped=False):
+    with self._lock:
+      self.is_closed = True
+      self.was_dropped = self.was_dropped or dropped
+      self._lock.notify_all()
+
+class WebsocketBroadcaster:
+  """Fans messages out to websocket clients without making the caller wait on any of them.
+
+  broadcast() just queues the message; a broadcaster thread serializes it once and adds it to each client's bounded
+  queue, and each client's own connection thread (see serve()) does the sending. Queued attendee_update messages for
+  the same attendee are coalesced, so a burst of updates sends only the latest. A client whose queue overflows is
+  dropped; the check-in page reconnects and catches up with GET /attendees?since=<version>."""
+
+  QUEUE_SIZE = 100 # messages a client can fall behind by before it's dropped
+  POLL_INTERVAL = 1.0 # seconds a connection thread waits for messages before checking whether its client went away
+
+  def __init__(self, max_queue=None):
+    self.max_queue = max_queue or self.QUEUE_SIZE
+    self._clients = set()
+    self._pending = [] # messages waiting for the broadcaster thread
+    self._lock = threading.Condition()
+    self._thread = None
+
+  def num_clients(self):
+    with self._lock:
+      return len(self._clients)
+
+  def broadcast(self, message):
+    with self._lock:
+      self._pending.append(message)
+      self._lock.notify_all()
+      if self._thread is None:
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+  # send queued messages to a websocket until it disconnects or is dropped. called from the websocket's route, on the
+  # connection's own thread.
+  def serve(self, ws):
+    client = WebsocketClient(ws, self.max_queue)
+    with self._lock:
+      self._clients.add(client)
+
+    try:
+      while not client.is_closed:
+        for payload in client.take(self.POLL_INTERVAL):
+          if client.is_closed:
+            break
+          ws.send(payload)
+        # we're not expecting any messages from the client, but this raises once the connection is closed
+        ws.receive(timeout=0)
+    finally:
+      client.close()
+      with self._lock:
+        self._clients.discard(client)
+      if client.was_dropped and ws.connected:
+        ws.close(message="Too far behind")
+
+  def run(self):
+    while True:
+      with self._lock:
+        self._lock.wait_for(lambda: len(self._pending) > 0)
+        messages = self._pending
+        self._pending = []
+        clients = list(self._clients)
+
+      for message in messages:
+        try:
+          self.deliver(message, clients)
+        except Exception as exc:
+          log.error(f"Error broadcasting message of type {message.get('type')} to websockets", exception=exc)
+
+  def deliver(self, message, clients):
+    payload = json.dumps(message)
+    key = None
+    if message.get('type') == 'attendee_update':
+      key = ('attendee_update', message.get('data', {}).get('badgefile_id'))
+
+    log.debug(f"Broadcasting message of type {message.get('type')} to {len(clients)} websocket clients")
+    for client in clients:
+      if not client.is_closed and not client.put(key, payload):
+        log.warn(f"Dropping websocket client with {client.max_queue} unsent messages")
+        client.close(dropped=True)